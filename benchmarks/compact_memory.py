@@ -0,0 +1,67 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Compare memory used per object with and without compact storage.
+
+Objects are created through the factory load from in-memory records, as well
+as created new and populated, so no database is needed.
+
+Usage: PYTHONPATH=. python benchmarks/compact_memory.py [objects] [columns]
+"""
+
+import sys
+import tracemalloc
+import medial
+
+
+def make_class(columns, compact):
+
+  return type('Wide', (medial.Persistent,), {
+    'table': 'wide',
+    'key': 'col0',
+    'compact': compact,
+    'persistence': {f'col{i}': {} for i in range(columns)},
+  })
+
+
+def populate(cls, rec):
+  obj = cls()
+  for (name, value) in rec.items():
+    setattr(obj, name, value)
+  return obj
+
+
+def measure(cls, records, new):
+
+  tracemalloc.start()
+  if new:
+    objects = [populate(cls, rec) for rec in records]
+  else:
+    objects = [cls(record=rec) for rec in records]
+  (current, _) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del objects
+  return current / len(records)
+
+
+def main():
+
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  columns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+  records = [
+    {f'col{i}': n * columns + i for i in range(columns)} for n in range(count)
+  ]
+
+  print(f"{count} objects, {columns} columns")
+  for (label, new) in (('loaded', False), ('new', True)):
+    regular = measure(make_class(columns, False), records, new)
+    compact = measure(make_class(columns, True), records, new)
+    print(f"{label}:")
+    print(f"  regular: {regular:8.1f} bytes/object")
+    print(f"  compact: {compact:8.1f} bytes/object")
+    print(f"  saved:   {regular - compact:8.1f} bytes/object ({1 - compact / regular:.0%})")
+
+
+if __name__ == '__main__':
+  main()
@@ -108,15 +108,47 @@ A longer string represented with `VARCHAR` or even `TEXT` is also possible.
 
 ### References to other persistent objects
 
-This is not yet implemented.
+A property whose type is another persistent class references an object of
+that class, and is stored in the database as the referenced object's key:
+
+```
+class Part(Persistent):
+  ...
+  persistence = {
+    ...
+    'maker': {
+      'type': Maker,
+      'column': 'maker_id'
+    }
+  }
+  ...
+...
+p = Part(1)
+print(p.maker.name)
+```
+
+The referenced object is looked up on first access of the property.  The
+property may be set to either an object or a key.  To avoid a query per object
+when handling many objects, their references can be looked up in batches with
+`Part.load_references(parts)`, or along with the objects themselves with
+`Part.load_many(keys, prefetch=True)`.
 
 """
 
 from . import exceptions
 from . import db
 from . import persistence
-
-from .db import configure, close, get_db, get_last_id
+from . import identity
+from . import aio
+from . import events
+from . import cache
+from . import columnar
+
+from .aio import aconnection, aget_db, arelease
+from .columnar import fetch_columns
+from .db import configure, close, connection, get_db, get_last_id, release
+from .db import transaction
+from .identity import identity_map
 from .persistence import Persistent
 
 # we don't import exceptions here because it's clearer if they're explicitly
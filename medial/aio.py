@@ -0,0 +1,224 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Asynchronous access to the database for use with asyncio.
+
+Each asynchronous connection wraps a connection checked out of the pool and
+runs all operations on it in a dedicated executor thread, so the event loop
+is never blocked and operations on the same connection are serialized.
+Different tasks holding different connections proceed concurrently.
+
+```
+async with medial.aconnection():
+  thing = Thing(name='example', new=True)
+  await thing.acommit()
+  async for row in await (await medial.aget_db()).execute("SELECT * FROM things"):
+    ...
+```
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, copy_context
+import functools
+from .db import DEFAULT, get_pool, _bind
+
+# asynchronous connections of the current context, by database name
+__checkout = ContextVar('medial_async_connection', default={})
+
+
+class AsyncCursor():
+  """
+  Asynchronous wrapper around a cursor, supporting `async for` iteration over
+  result rows, which are fetched in batches.
+  """
+
+  def __init__(self, conn, cursor, batch_size=100):
+    self._conn = conn
+    self._cursor = cursor
+    self._batch_size = batch_size
+    self._batch = []
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  async def fetchone(self):
+    return await self._conn.run(self._cursor.fetchone)
+
+  async def fetchmany(self, size=None):
+    size = size or self._batch_size
+    return await self._conn.run(self._cursor.fetchmany, size)
+
+  async def fetchall(self):
+    return await self._conn.run(self._cursor.fetchall)
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if not self._batch:
+      self._batch = list(await self.fetchmany() or [])
+      if not self._batch:
+        raise StopAsyncIteration
+    return self._batch.pop(0)
+
+
+class AsyncConnection():
+  """
+  Asynchronous wrapper around a pooled database connection.
+
+  Args:
+    pool (Pool): Pool the connection was checked out of.
+    conn: The database connection.
+    name (str): Name of the database.
+  """
+
+  def __init__(self, pool, conn, name=DEFAULT):
+    self.pool = pool
+    self.conn = conn
+    self.name = name
+    self.type = conn.type
+    self._executor = ThreadPoolExecutor(max_workers=1,
+                                        thread_name_prefix='medial-aio')
+
+  @property
+  def closed(self):
+    return self.pool.closed
+
+  async def run(self, fn, *args, **kwargs):
+    """
+    Run a synchronous function in the connection's executor thread, with the
+    connection as that returned by `get_db()` for the duration of the call.
+    The function runs in a copy of the caller's context, so that scopes such
+    as identity maps carry over.
+
+    Returns: The function's return value.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = copy_context()
+    return await loop.run_in_executor(
+      self._executor, functools.partial(ctx.run, self._call, fn, args, kwargs)
+    )
+
+  def _call(self, fn, args, kwargs):
+    with _bind(self.pool, self.conn, self.name):
+      return fn(*args, **kwargs)
+
+  async def execute(self, sql, parameters=None):
+    cursor = await self.run(self.conn.execute, sql, parameters)
+    return AsyncCursor(self, cursor)
+
+  async def executemany(self, sql, seq):
+    cursor = await self.run(self.conn.executemany, sql, seq)
+    return AsyncCursor(self, cursor)
+
+  async def executescript(self, sql):
+    return await self.run(self.conn.executescript, sql)
+
+  async def commit(self):
+    return await self.run(self.conn.commit)
+
+  async def rollback(self):
+    return await self.run(self.conn.rollback)
+
+  async def release(self):
+    """
+    Release the connection back to the pool and stop the executor thread.
+    The connection is released in the executor thread, both so that rolling
+    it back does not block the event loop and so that it is only released
+    once any operation still running on it, such as one whose task was
+    cancelled, has finished.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+      await loop.run_in_executor(self._executor, self.pool.release, self.conn)
+    finally:
+      await loop.run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+
+
+async def __acquire(name):
+  pool = get_pool(name)
+  loop = asyncio.get_running_loop()
+
+  # checking out may block while waiting for a connection to be released
+  conn = await loop.run_in_executor(None, pool.acquire)
+  return AsyncConnection(pool, conn, name)
+
+
+def __with(name, aconn):
+  checkouts = dict(__checkout.get())
+  if aconn is None:
+    checkouts.pop(name, None)
+  else:
+    checkouts[name] = aconn
+  return checkouts
+
+
+async def aget_db(name=None):
+  """
+  Get asynchronous database connection for the current context, checking one
+  out of the pool if necessary.  Outside of an `aconnection()` scope the
+  connection remains checked out until `arelease()` is called.
+
+  Args:
+    name (str): Name of the database.  Defaults to the default database.
+
+  Returns: Asynchronous database connection.
+  """
+
+  name = name or DEFAULT
+  aconn = __checkout.get().get(name)
+  if aconn is not None and not aconn.closed:
+    return aconn
+
+  aconn = await __acquire(name)
+  __checkout.set(__with(name, aconn))
+  return aconn
+
+
+async def arelease(name=None):
+  """
+  Release the asynchronous database connection of the current context back
+  to the pool.
+
+  Args:
+    name (str): Name of the database.  Defaults to all databases.
+  """
+
+  checkouts = __checkout.get()
+  for el in (list(checkouts) if name is None else [name]):
+    aconn = checkouts.get(el)
+    if aconn is not None:
+      __checkout.set(__with(el, None))
+      await aconn.release()
+
+
+@asynccontextmanager
+async def aconnection(name=None):
+  """
+  Asynchronous context manager checking out a database connection for the
+  enclosed block and releasing it afterwards.  Nested blocks share the
+  outermost connection.
+
+  Args:
+    name (str): Name of the database.  Defaults to the default database.
+
+  Returns: Asynchronous database connection.
+  """
+
+  name = name or DEFAULT
+  aconn = __checkout.get().get(name)
+  if aconn is not None and not aconn.closed:
+    yield aconn
+    return
+
+  aconn = await __acquire(name)
+  token = __checkout.set(__with(name, aconn))
+  try:
+    yield aconn
+  finally:
+    __checkout.reset(token)
+    await aconn.release()
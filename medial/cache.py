@@ -0,0 +1,217 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Read-through caches of stored records.
+
+A persistent class may declare a cache as a class attribute, in which case
+lookups by key through `load()`, `get()` and `load_many()` consult it before
+querying the database, and records read from the database are added to it.
+Committing or deleting an object invalidates its entry, and again at the end
+of the transaction if within a `medial.transaction()` block, which lookups
+bypass the cache.
+
+```
+class Colour(Persistent):
+  table = 'colours'
+  cache = medial.cache.MemoryCache(size=10000, ttl=300)
+  ...
+```
+
+Records are cached by table and key, so one cache may be shared by several
+classes.  Entries expire after the cache's time to live, which bounds how
+long updates made by other processes, or outside of Medial, go unnoticed.
+
+Two backends are provided: `MemoryCache` holds records in the process, and
+`FileCache` holds them in an SQLite file which may be shared by several
+worker processes.  Other backends can be provided by subclassing `Cache`.
+"""
+
+from collections import OrderedDict
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class Cache():
+  """
+  Base class of caches.  Subclasses implement `_get()`, `_set()`,
+  `_delete()` and `_clear()`.
+
+  Args:
+    ttl (float): Seconds after which entries expire.  `None` for no expiry.
+
+  Attributes:
+    hits (int): Number of lookups which found a record.
+    misses (int): Number of lookups which did not.
+  """
+
+  def __init__(self, ttl=None):
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """
+    Look up a record.
+
+    Args:
+      key (tuple): Table and key of the record.
+
+    Returns: The record as a dict of columns and values, or `None` if not
+      cached or expired.
+    """
+    with self._lock:
+      record = self._get(key)
+      if record is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return record
+
+  def set(self, key, record):
+    """
+    Add or replace a record.
+
+    Args:
+      key (tuple): Table and key of the record.
+      record (dict): Columns and values as stored in the database.
+    """
+    with self._lock:
+      self._set(key, record)
+
+  def delete(self, key):
+    """
+    Remove a record, if cached.
+    """
+    with self._lock:
+      self._delete(key)
+
+  def clear(self):
+    """
+    Remove all records.
+    """
+    with self._lock:
+      self._clear()
+
+  def reset_stats(self):
+    """
+    Reset hit and miss counters.
+    """
+    with self._lock:
+      self.hits = 0
+      self.misses = 0
+
+  def _get(self, key):
+    raise NotImplementedError
+
+  def _set(self, key, record):
+    raise NotImplementedError
+
+  def _delete(self, key):
+    raise NotImplementedError
+
+  def _clear(self):
+    raise NotImplementedError
+
+
+class MemoryCache(Cache):
+  """
+  Cache held in the process, evicting the least recently used record once
+  the size limit is reached.
+
+  Args:
+    size (int): Maximum number of records held.  `None` for no limit.
+    ttl (float): Seconds after which entries expire.  `None` for no expiry.
+  """
+
+  def __init__(self, size=1000, ttl=None):
+    super().__init__(ttl)
+    self.size = size
+    self._records = OrderedDict()
+
+  def __len__(self):
+    return len(self._records)
+
+  def _get(self, key):
+    try:
+      (expires, record) = self._records[key]
+    except KeyError:
+      return None
+    if expires is not None and expires <= time.monotonic():
+      del self._records[key]
+      return None
+    self._records.move_to_end(key)
+    return record
+
+  def _set(self, key, record):
+    expires = None if self.ttl is None else time.monotonic() + self.ttl
+    self._records[key] = (expires, record)
+    self._records.move_to_end(key)
+    if self.size is not None and len(self._records) > self.size:
+      self._records.popitem(last=False)
+
+  def _delete(self, key):
+    self._records.pop(key, None)
+
+  def _clear(self):
+    self._records.clear()
+
+
+class FileCache(Cache):
+  """
+  Cache held in an SQLite file, which may be shared by several processes.
+  Records are pickled, so the file must only be writable by trusted
+  processes.  Hit and miss counters are kept per instance.
+
+  Args:
+    path (str): Path of the cache file, created if necessary.
+    ttl (float): Seconds after which entries expire.  `None` for no expiry.
+    timeout (float): Seconds to wait for other processes to release a lock
+      on the file.
+  """
+
+  def __init__(self, path, ttl=None, timeout=5):
+    super().__init__(ttl)
+    self.path = path
+    self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None,
+                                 check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute(
+      "CREATE TABLE IF NOT EXISTS medial_cache "
+      "(key TEXT PRIMARY KEY, record BLOB, expires REAL)"
+    )
+
+  def _get(self, key):
+    res = self._conn.execute(
+      "SELECT record, expires FROM medial_cache WHERE key = ?", (repr(key),)
+    ).fetchone()
+    if res is None:
+      return None
+    (record, expires) = res
+    if expires is not None and expires <= time.time():
+      self._delete(key)
+      return None
+    return pickle.loads(record)
+
+  def _set(self, key, record):
+    expires = None if self.ttl is None else time.time() + self.ttl
+    self._conn.execute(
+      "INSERT OR REPLACE INTO medial_cache (key, record, expires) VALUES (?, ?, ?)",
+      (repr(key), pickle.dumps(record), expires)
+    )
+
+  def _delete(self, key):
+    self._conn.execute("DELETE FROM medial_cache WHERE key = ?", (repr(key),))
+
+  def _clear(self):
+    self._conn.execute("DELETE FROM medial_cache")
+
+  def close(self):
+    """
+    Close the cache file.
+    """
+    with self._lock:
+      self._conn.close()
@@ -0,0 +1,92 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Column-oriented query results.
+
+For reporting and analysis it is often more convenient, and much lighter on
+memory, to have the results of a query as one sequence of values per column
+rather than one row object per record.  `fetch_columns()` builds such results
+batch by batch, so that the full result set is never held as rows.
+
+```
+columns = medial.fetch_columns("SELECT name, model_no FROM products")
+print(sum(columns['model_no']) / len(columns['model_no']))
+```
+
+Values may also be returned as NumPy arrays, if NumPy is installed.  See also
+`Persistent.select_columns()`, which decodes enumerations according to the
+class's persistence specification.
+"""
+
+from .db import get_db
+from . import exceptions
+
+
+def enum_decoder(terp):
+  """
+  Returns function decoding a sequence of stored values to members of the
+  given enumeration, looking each distinct value up only once.
+  """
+  members = {member.value: member for member in terp}
+  members[None] = None
+
+  def decode(values):
+    try:
+      return [members[value] for value in values]
+    except KeyError:
+      # raise the enumeration's own error for the invalid value
+      return [terp(value) if value is not None else None for value in values]
+  return decode
+
+
+def fetch_columns(sql, parameters=None, numpy=False, decoders=None, batch_size=1000,
+                  database=None):
+  """
+  Run a query and return its results by column.
+
+  Args:
+    sql (str): The query.
+    parameters (list): Query parameters.
+    numpy (bool): Whether to return NumPy arrays rather than lists.
+    decoders (dict): Functions by column name, each taking a batch of the
+      column's values and returning a list of decoded values.
+    batch_size (int): Number of rows fetched at a time.
+    database (str): Name of the database.  Defaults to the default database.
+
+  Returns: Dict of column names and their values, in the order of the query's
+    columns.  If the query returns no rows the dict is empty, since column
+    names are only known from the rows.
+
+  Raises:
+    DuplicateColumn: The query returns more than one column of the same name;
+      give such columns distinct names with `AS`.
+  """
+
+  if numpy:
+    # pylint: disable=import-outside-toplevel
+    import numpy as np
+
+  decoders = decoders or {}
+  columns = {}
+  for batch in get_db(database, read=True).stream(sql, parameters, batch_size):
+    if not columns:
+      names = batch[0].keys()
+      # rows may not list repeated names, so compare with the row's width
+      if len(set(names)) != len(batch[0]):
+        duplicate = next((name for name in names if names.count(name) > 1), names[0])
+        raise exceptions.DuplicateColumn(duplicate)
+      columns = {name: [] for name in names}
+    for (name, values) in zip(columns, zip(*batch)):
+      decoder = decoders.get(name)
+      if decoder:
+        values = decoder(values)
+      if numpy:
+        # converting batch by batch frees the rows' values as we go
+        columns[name].append(np.asarray(values))
+      else:
+        columns[name].extend(values)
+
+  if numpy:
+    return {name: np.concatenate(chunks) for (name, chunks) in columns.items()}
+  return columns
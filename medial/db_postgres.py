@@ -1,35 +1,143 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+from collections import OrderedDict
+from functools import lru_cache
+import io
 import psycopg2
 import psycopg2.extensions
+from . import events
+from .db_sqlite import nextqparm
+
+
+@lru_cache(maxsize=512)
+def pyformat(sql):
+  """
+  Rewrite SQLite-style query placeholders ("?") to those used by psycopg2.
+  """
+  return sql.replace('?', '%s')
+
+
+def copy_value(value):
+  """
+  Render a value in the text format of `COPY`.
+
+  Raises:
+    TypeError: The value is a container, whose string the text format would
+      not represent faithfully.
+  """
+  if value is None:
+    return '\\N'
+  if isinstance(value, bool):
+    return 't' if value else 'f'
+  if isinstance(value, (bytes, bytearray, memoryview)):
+    # bytea hex format, with its backslash escaped
+    return '\\\\x' + bytes(value).hex()
+  if isinstance(value, (list, tuple, set, dict)):
+    raise TypeError(f"Cannot copy value of type '{type(value).__name__}'")
+  return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+          .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def numbered(sql):
+  """
+  Rewrite SQLite-style query placeholders ("?") to the numbered placeholders
+  used by prepared statements ("$1", "$2", ...), ignoring any in quoted
+  strings.
+
+  Returns: Tuple of rewritten query string and number of placeholders.
+  """
+  tokens = list(nextqparm(sql))
+  numbered_sql = tokens[0]
+  for (i, token) in enumerate(tokens[1:], 1):
+    numbered_sql += f"${i}" + token
+  return (numbered_sql, len(tokens) - 1)
+
+
+class Row():
+  """
+  Row of a result set, similar to SQLite3's Row class.  Values are held in a
+  tuple and may be accessed by column name or position; the mapping of names
+  to positions is shared by all rows of a result set.  Rows can be converted
+  with `dict()`.
+  """
+
+  __slots__ = ('_values', '_index')
+
+  def __init__(self, values, index):
+    self._values = values
+    self._index = index
+
+  def keys(self):
+    return list(self._index)
+
+  def __getitem__(self, key):
+    if isinstance(key, str):
+      return self._values[self._index[key]]
+    return self._values[key]
+
+  def __iter__(self):
+    return iter(self._values)
+
+  def __len__(self):
+    return len(self._values)
+
+  def __eq__(self, other):
+    if isinstance(other, Row):
+      return self._index == other._index and self._values == other._values
+    return NotImplemented
+
+  def __hash__(self):
+    return hash(self._values)
+
+  def __repr__(self):
+    return f"Row({dict(zip(self._index, self._values))!r})"
 
 
 class DictCursor(psycopg2.extensions.cursor):
   """
   Custom cursor factory to provide name-subscriptable fields, similar to that
-  provided by SQLite3 by default.  It may be slightly more efficient to use
-  numerical subscripts, but this is self-documenting in the code.
+  provided by SQLite3 by default.  Rows are returned as `Row` objects.
   """
 
+  def _row_index(self):
+    # description is recreated with each query, so rebuild the index only
+    # when it changes
+    description = self.description
+    if getattr(self, '_indexed', None) is not description:
+      self._index = {col.name: i for (i, col) in enumerate(description)}
+      self._indexed = description
+    return self._index
+
   def fetchone(self):
     tup = super().fetchone()
     if tup:
-      return {self.description[x].name: tup[x] for x in range(0, len(tup))}
+      return Row(tup, self._row_index())
     return None
 
+  def fetchmany(self, size=None):
+    tup = super().fetchmany(self.arraysize if size is None else size)
+    if not tup:
+      return []
+    index = self._row_index()
+    return [Row(row, index) for row in tup]
+
   def fetchall(self):
     tup = super().fetchall()
     if tup:
-      numcols = len(tup[0])
-      numrows = len(tup)
-      return [
-        {
-          self.description[y].name: tup[x][y] for y in range(0, numcols)
-        } for x in range(0, numrows)
-      ]
+      index = self._row_index()
+      return [Row(row, index) for row in tup]
     return None
 
+  def __iter__(self):
+    # the base class's iterator is the cursor itself, so fetch rows directly
+    # rather than recursing into this method
+    index = None
+    for tup in iter(super().fetchone, None):
+      if index is None:
+        index = self._row_index()
+      yield Row(tup, index)
+
 class ExtConnection(psycopg2.extensions.connection):
   """
   Custom connection class which reports its type and provides shortcuts to
@@ -40,24 +148,146 @@ class ExtConnection(psycopg2.extensions.connection):
   type = 'postgres'
   ext = 'psql'
 
-  def execute(self, sql, parameters=None):
+  # whether INSERT ... RETURNING is supported
+  returning = True
+
+  def execute(self, sql, parameters=None, prepare=False):
+    """
+    Execute query, optionally as a prepared statement.  Statements are
+    prepared once per connection on first use.  Prepared statements share a
+    single cursor, whose results must be consumed before the next prepared
+    statement is executed.
+    """
+    if events.active:
+      return events.observe(lambda: self._execute(sql, parameters, prepare),
+                            sql, parameters)
+    return self._execute(sql, parameters, prepare)
+
+  def _execute(self, sql, parameters, prepare):
+    if prepare:
+      cursor = self._shared_cursor()
+      cursor.execute(self._prepared(sql), parameters)
+      return cursor
+    cursor = self.cursor()
+    cursor.execute(pyformat(sql), parameters)
+    return cursor
+
+  def executemany(self, sql, seq, prepare=False):
+    if events.active:
+      return events.observe(lambda seq: self._executemany(sql, seq, prepare),
+                            sql, seq, many=True)
+    return self._executemany(sql, seq, prepare)
+
+  def _executemany(self, sql, seq, prepare):
+    if prepare:
+      cursor = self._shared_cursor()
+      cursor.executemany(self._prepared(sql), seq)
+      return cursor
     cursor = self.cursor()
-    cursor.execute(sql.replace('?', '%s'), parameters)
+    cursor.executemany(pyformat(sql), seq)
     return cursor
 
-  def executemany(self, sql, seq):
+  # number of prepared statements kept per connection
+  max_prepared = 256
+
+  def _prepared(self, sql):
+    """
+    Prepare statement if not already prepared on this connection.  At most
+    `max_prepared` statements are kept; beyond that the least recently used
+    is deallocated, so that connections running many distinct queries do not
+    accumulate statements on the server.
+
+    Returns: Query string executing the prepared statement.
+    """
+    statements = self.__dict__.get('_statements')
+    if statements is None:
+      statements = self._statements = OrderedDict()
+    try:
+      statements.move_to_end(sql)
+      return statements[sql][1]
+    except KeyError:
+      pass
+    self._prepare_count = getattr(self, '_prepare_count', 0) + 1
+    name = f"medial_{self._prepare_count}"
+    (numbered_sql, count) = numbered(sql)
     cursor = self.cursor()
-    cursor.executemany(sql.replace('?', '%s'), seq)
+    while statements and len(statements) >= self.max_prepared:
+      (_, (evicted, _)) = statements.popitem(last=False)
+      cursor.execute(f"DEALLOCATE {evicted}")
+    cursor.execute(f"PREPARE {name} AS {numbered_sql}")
+    if count:
+      execute_sql = f"EXECUTE {name} (" + ", ".join(['%s'] * count) + ")"
+    else:
+      execute_sql = f"EXECUTE {name}"
+    statements[sql] = (name, execute_sql)
+    return execute_sql
+
+  def _shared_cursor(self):
+    cursor = self.__dict__.get('_cursor')
+    if cursor is None or cursor.closed:
+      cursor = self.cursor()
+      self._cursor = cursor
     return cursor
 
   def executescript(self, sql):
+    if events.active:
+      return events.observe(lambda: self._executescript(sql), sql, None)
+    return self._executescript(sql)
+
+  def _executescript(self, sql):
     cursor = self.cursor()
     cursor.execute(sql)
     return cursor
 
+  def copy_rows(self, table, columns, rows):
+    """
+    Insert rows of values for the given columns into a table by streaming
+    them through `COPY ... FROM STDIN`, which is considerably faster than
+    inserting them with `INSERT` statements.
+    """
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    if events.active:
+      return events.observe(lambda rows: self._copy_rows(sql, rows), sql, rows, many=True)
+    return self._copy_rows(sql, rows)
+
+  def _copy_rows(self, sql, rows):
+    data = io.StringIO()
+    for row in rows:
+      data.write("\t".join([copy_value(value) for value in row]))
+      data.write("\n")
+    data.seek(0)
+    cursor = self.cursor()
+    cursor.copy_expert(sql, data)
+    return cursor
+
+  def stream(self, sql, parameters=None, batch_size=1000):
+    """
+    Generator yielding the results of a query in batches of rows, using a
+    named server-side cursor so that only one batch is held in memory.  The
+    cursor is declared `WITH HOLD` so that, as on SQLite, the connection may
+    be committed while iterating; the remaining results are then held by the
+    server until the cursor is closed.
+    """
+    self._stream_count = getattr(self, '_stream_count', 0) + 1
+    cursor = self.cursor(name=f"medial_stream_{self._stream_count}", withhold=True)
+    cursor.itersize = batch_size
+    try:
+      if events.active:
+        events.observe(lambda: cursor.execute(pyformat(sql), parameters), sql, parameters)
+      else:
+        cursor.execute(pyformat(sql), parameters)
+      while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+          break
+        yield rows
+    finally:
+      cursor.close()
+
 
-def open_db_postgres(uri):
+def open_db_postgres(uri, **options):
   db = psycopg2.connect(uri,
                         connection_factory=ExtConnection,
-                        cursor_factory=DictCursor)
+                        cursor_factory=DictCursor,
+                        **options)
   return db
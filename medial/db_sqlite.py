@@ -1,10 +1,53 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+from functools import lru_cache
 import re
 import sqlite3
+from urllib.parse import parse_qsl, unquote_plus
+from . import events
 from .exceptions import ConstraintViolation
 
+# RE for tokenizing query strings into everything not '?' token
+QPARM_REGEX = re.compile("((?:[^?']*(?:'[^']*')?)*)")
+
+# number of distinct query and parameter shape combinations to keep expanded
+EXPANSION_CACHE_SIZE = 512
+
+# tuning options applied as pragmas on opening connections, in this order
+PRAGMAS = [
+  'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store',
+  'busy_timeout',
+]
+
+# tuning options passed to sqlite3.connect()
+CONNECT_OPTIONS = ['cached_statements']
+
+# named sets of tuning options, selected with the `preset` option
+PRESETS = {
+  # concurrent readers alongside a writer
+  'read-heavy': {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+    'cached_statements': 256,
+  },
+  # large loads, trading durability in case of a system crash for speed
+  'bulk-load': {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,
+  },
+}
+
+# RE for values safe to interpolate into pragma statements
+PRAGMA_VALUE_REGEX = re.compile(r"^-?[A-Za-z0-9_]+$")
+
 def iter_flatten(iterable):
   """
   Iterator for flattening a list or tuple.  Can be nested.
@@ -34,12 +77,9 @@ def nextqparm(sql):
   parameter list) when iteration is done.
   """
 
-  # RE for tokenizing query strings into everything not '?' token
-  regex = re.compile("((?:[^?']*(?:'[^']*')?)*)")
-
   # iterate through regular expression matches
   everythingelse = ''
-  for m in regex.finditer(sql):
+  for m in QPARM_REGEX.finditer(sql):
 
     # hit a query parameter placeholder?
     if m.groups()[0] == '':
@@ -58,6 +98,41 @@ def nextqparm(sql):
   #if everythingelse != '':
   #  yield everythingelse
 
+@lru_cache(maxsize=EXPANSION_CACHE_SIZE)
+def expand_query(sql, shape):
+  """
+  Rewrite a query string so that each placeholder for a list or tuple
+  parameter becomes a comma-separated series of placeholders, one for each
+  element.  Results are cached, as the same statements tend to be issued
+  repeatedly with parameters of the same shape.
+
+  Args:
+    sql (str): Query string.
+    shape (tuple): For each query parameter, the length of the list or tuple,
+      or `None` for a scalar parameter.
+
+  Returns: Rewritten query string.
+  """
+
+  # iterator breaks query string down into static tokens: points of
+  # separation indicate query parameters
+  qparms = nextqparm(sql)
+
+  # consume static tokens between query parameters
+  tokens = []
+  for length in shape:
+    tokens.append(next(qparms))
+    if length is None:
+      tokens.append('?')
+    else:
+      tokens.append(','.join(['?'] * length))
+
+  # use up remaining string tokens
+  # TODO: there should only be one
+  tokens.extend(qparms)
+
+  return ''.join(tokens)
+
 class ExtConnection(sqlite3.Connection):
   """
   The SQLite3 connection object is subclassed to normalize it with the Postgres
@@ -70,37 +145,34 @@ class ExtConnection(sqlite3.Connection):
   type = 'sqlite'
   ext = 'sql'
 
+  # whether INSERT ... RETURNING is supported
+  returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
   # TODO: this is faked out and possibly unnecessary anyway, since the
   #       Postgres driver can throw an exception.
   closed = 0
 
-  def execute(self, sql, parameters=None):
+  def execute(self, sql, parameters=None, prepare=False):
     """
     Extend sqlite3.Connection.execute() in order to handle lists and tuples
-    as query parameters.
+    as query parameters.  The `prepare` argument is accepted for
+    compatibility with the Postgres connection class and has no effect, since
+    SQLite3 caches prepared statements itself.
     """
 
-    if parameters:
-      newsql = ''
+    if events.active:
+      return events.observe(lambda: self._execute(sql, parameters), sql, parameters)
+    return self._execute(sql, parameters)
 
-      # iterator breaks query string down into static tokens: points of
-      # separation indicate query parameters
-      qparms = nextqparm(sql)
+  def _execute(self, sql, parameters):
 
-      # consume static tokens between query parameters
-      for p in parameters:
-        newsql += next(qparms)
-        if isinstance(p, (list, tuple)):
-          newsql += ','.join(['?'] * len(p))
-        else:
-          newsql += '?'
-
-      # use up remaining string tokens
-      # TODO: there should only be one
-      for tok in qparms:
-        newsql += tok
-
-      sql = newsql
+    # only rewrite the query if there is something to expand, otherwise the
+    # query and parameters are passed through untouched
+    if parameters and any(isinstance(p, (list, tuple)) for p in parameters):
+      shape = tuple(
+        len(p) if isinstance(p, (list, tuple)) else None for p in parameters
+      )
+      sql = expand_query(sql, shape)
       parameters = flatten(parameters)
 
     try:
@@ -111,7 +183,104 @@ class ExtConnection(sqlite3.Connection):
 
     return res
 
-def open_db_sqlite(uri):
+  def executemany(self, sql, seq_of_parameters, prepare=False):
+    """
+    Extend sqlite3.Connection.executemany() in order to report constraint
+    violations consistently with execute().  As with execute(), `prepare` has
+    no effect.
+    """
+
+    if events.active:
+      return events.observe(lambda seq: self._executemany(sql, seq), sql,
+                            seq_of_parameters, many=True)
+    return self._executemany(sql, seq_of_parameters)
+
+  def _executemany(self, sql, seq_of_parameters):
+
+    try:
+      res = sqlite3.Connection.executemany(self, sql, seq_of_parameters)
+    except sqlite3.IntegrityError as e:
+      # pylint: disable=W0707
+      raise ConstraintViolation(str(e))
+
+    return res
+
+  def executescript(self, sql):
+    if events.active:
+      return events.observe(lambda: sqlite3.Connection.executescript(self, sql), sql, None)
+    return sqlite3.Connection.executescript(self, sql)
+
+  def copy_rows(self, table, columns, rows):
+    """
+    Insert rows of values for the given columns into a table with a single
+    `executemany()` call.  The Postgres connection class uses `COPY` instead.
+    """
+    placeholders = ", ".join(['?'] * len(columns))
+    return self.executemany(
+      f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows
+    )
+
+  def stream(self, sql, parameters=None, batch_size=1000):
+    """
+    Generator yielding the results of a query in batches of rows, so that only
+    one batch is held in memory.
+    """
+    cursor = self.execute(sql, parameters)
+    try:
+      while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+          break
+        yield rows
+    finally:
+      cursor.close()
+
+def tuning(uri, options):
+  """
+  Separate tuning options given in the query string of a URI from it, and
+  combine them with those given otherwise, which take precedence, on top of
+  the options of any preset.
+
+  Returns: Tuple of URI without tuning options and dict of options.  The URI
+    is otherwise left as given, since SQLite accepts URIs such as
+    `file:data.db` which would not survive being parsed and rebuilt.
+
+  Raises:
+    ValueError: An option or preset is not known.
+  """
+
+  known = PRAGMAS + CONNECT_OPTIONS + ['preset']
+  (base, sep, query) = uri.partition('?')
+  (query, hashmark, fragment) = query.partition('#')
+  params = parse_qsl(query, keep_blank_values=True)
+  given = {name: value for (name, value) in params if name in known}
+  if given:
+    # strip tuning options from the query string, leaving the rest as is
+    kept = [
+      el for el in query.split('&')
+      if el and unquote_plus(el.split('=', 1)[0]) not in known
+    ]
+    uri = base + (sep + '&'.join(kept) if kept else '') + hashmark + fragment
+  given.update(options)
+
+  unknown = set(given) - set(known)
+  if unknown:
+    raise ValueError(f"Unknown SQLite tuning options: {', '.join(sorted(unknown))}")
+
+  combined = {}
+  preset = given.pop('preset', None)
+  if preset:
+    try:
+      combined.update(PRESETS[preset])
+    except KeyError:
+      # pylint: disable=W0707
+      raise ValueError(f"Unknown SQLite tuning preset: '{preset}'")
+  combined.update(given)
+
+  return (uri, combined)
+
+
+def open_db_sqlite(uri, **options):
   """
   Open SQLite database connection.  Uses internal subclass of SQLite3's
   Connection class with a few extras.
@@ -123,9 +292,35 @@ def open_db_sqlite(uri):
   DB-API v2.
 
   For SQLite: support the use of lists or tuples in query parameters.
+
+  Connections are pooled and so may be used by a thread other than the one
+  which opened them, though never by more than one thread at a time.
+
+  Tuning options may be given in the URI's query string or as keyword
+  arguments, which take precedence: the pragmas `journal_mode`, `synchronous`,
+  `cache_size`, `mmap_size`, `temp_store` and `busy_timeout`, SQLite3's
+  `cached_statements`, and `preset`, naming one of `PRESETS` whose options
+  are applied first.  For example:
+  `file:///var/lib/app.sqlite?preset=read-heavy&synchronous=FULL`.
   """
 
-  db = ExtConnection(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+  (uri, options) = tuning(uri, options)
+  kwargs = {}
+  if 'cached_statements' in options:
+    kwargs['cached_statements'] = int(options['cached_statements'])
+
+  db = ExtConnection(uri, uri=True, check_same_thread=False,
+                     detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                     **kwargs)
   db.row_factory = sqlite3.Row
 
+  for pragma in PRAGMAS:
+    if pragma in options:
+      value = str(options[pragma])
+      if not PRAGMA_VALUE_REGEX.match(value):
+        db.close()
+        raise ValueError(f"Invalid value for SQLite pragma {pragma}: '{value}'")
+      # journal_mode reports the resulting mode, which must be fetched
+      db.execute(f"PRAGMA {pragma}={value}").fetchall()
+
   return db
@@ -0,0 +1,221 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Query instrumentation.
+
+Listeners subscribed here are called before and after every statement
+executed through Medial's connection classes, receiving a `QueryEvent`
+describing it.  When no listener is subscribed, executing a statement costs a
+single flag check.
+
+```
+stats = medial.events.QueryStats()
+medial.events.subscribe(after=stats)
+medial.events.subscribe(after=medial.events.SlowQueryLogger(threshold=0.5))
+...
+for (sql, stat) in stats.report():
+  print(sql, stat['count'], stat['total'])
+```
+
+Two listeners are provided: `SlowQueryLogger` logs statements taking longer
+than a threshold, and `QueryStats` aggregates timings per statement.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import threading
+import time
+
+# whether any listener is subscribed; checked on every statement
+active = False
+
+__before = []
+__after = []
+
+# Persistent class on whose behalf statements of the current context are
+# executed, set by its persistence methods
+__persistent = ContextVar('medial_persistent', default=None)
+
+
+class QueryEvent():
+  """
+  Describes an executed statement.
+
+  Attributes:
+    sql (str): The statement as given to the connection.
+    params (int): Number of parameters, or of parameter sets for
+      `executemany()`.
+    many (bool): Whether the statement was executed with `executemany()`.
+    persistent (type): The Persistent class on whose behalf the statement
+      was executed, if any.
+    elapsed (float): Seconds taken to execute; set after execution.
+    rowcount (int): Rows affected or returned as reported by the cursor, or
+      -1 if not known; set after execution.
+    error (Exception): Exception raised by execution, if any; set after
+      execution.
+  """
+
+  __slots__ = ('sql', 'params', 'many', 'persistent', 'elapsed', 'rowcount', 'error')
+
+  def __init__(self, sql, params, many, persistent):
+    self.sql = sql
+    self.params = params
+    self.many = many
+    self.persistent = persistent
+    self.elapsed = None
+    self.rowcount = -1
+    self.error = None
+
+
+def subscribe(before=None, after=None):
+  """
+  Subscribe listeners to statement execution.
+
+  Args:
+    before (callable): Called with a `QueryEvent` before each statement.
+    after (callable): Called with a `QueryEvent` after each statement, even
+      if it failed.
+  """
+
+  global active # pylint: disable=global-statement
+  if before:
+    __before.append(before)
+  if after:
+    __after.append(after)
+  active = bool(__before or __after)
+
+
+def unsubscribe(before=None, after=None):
+  """
+  Unsubscribe listeners previously subscribed.
+  """
+
+  global active # pylint: disable=global-statement
+  if before in __before:
+    __before.remove(before)
+  if after in __after:
+    __after.remove(after)
+  active = bool(__before or __after)
+
+
+def persistent():
+  """
+  Returns the Persistent class on whose behalf statements of the current
+  context are executed, if any.
+  """
+  return __persistent.get()
+
+
+@contextmanager
+def on_behalf_of(cls):
+  """
+  Context manager noting that statements executed in the enclosed block are
+  on behalf of the given Persistent class, as reported by their events.
+  """
+  token = __persistent.set(cls)
+  try:
+    yield
+  finally:
+    __persistent.reset(token)
+
+
+def observe(execute, sql, params, many=False):
+  """
+  Execute a statement, notifying listeners before and after.
+
+  Args:
+    execute (callable): Function executing the statement and returning the
+      cursor.
+    sql (str): The statement.
+    params: Parameters, or sequence of parameter sets.
+    many (bool): Whether this is an `executemany()` call.
+
+  Returns: The cursor returned by `execute`.
+  """
+
+  if many:
+    params = list(params)
+  event = QueryEvent(sql, len(params) if params else 0, many, __persistent.get())
+  for listener in list(__before):
+    listener(event)
+
+  start = time.perf_counter()
+  try:
+    cursor = execute(params) if many else execute()
+    event.rowcount = getattr(cursor, 'rowcount', -1)
+    return cursor
+  except Exception as e:
+    event.error = e
+    raise
+  finally:
+    event.elapsed = time.perf_counter() - start
+    for listener in list(__after):
+      listener(event)
+
+
+class SlowQueryLogger():
+  """
+  Listener logging statements taking at least the given time.
+
+  Args:
+    threshold (float): Seconds.
+    logger (logging.Logger): Logger to use.  Defaults to the `medial` logger.
+    level (int): Logging level.
+  """
+
+  def __init__(self, threshold=0.1, logger=None, level=logging.WARNING):
+    self.threshold = threshold
+    self.logger = logger or logging.getLogger('medial')
+    self.level = level
+
+  def __call__(self, event):
+    if event.elapsed >= self.threshold:
+      self.logger.log(self.level, "Slow query (%.3fs, %d rows, %s): %s",
+                      event.elapsed, event.rowcount,
+                      event.persistent.__name__ if event.persistent else '-',
+                      event.sql)
+
+
+class QueryStats():
+  """
+  Listener aggregating the number of executions, timings and row counts of
+  each distinct statement.  Safe to use from several threads.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stats = {}
+
+  def __call__(self, event):
+    with self._lock:
+      stat = self._stats.get(event.sql)
+      if stat is None:
+        stat = self._stats[event.sql] = {
+          'count': 0, 'errors': 0, 'total': 0.0,
+          'min': event.elapsed, 'max': event.elapsed, 'rows': 0,
+        }
+      stat['count'] += 1
+      stat['total'] += event.elapsed
+      stat['min'] = min(stat['min'], event.elapsed)
+      stat['max'] = max(stat['max'], event.elapsed)
+      if event.error:
+        stat['errors'] += 1
+      elif event.rowcount > 0:
+        stat['rows'] += event.rowcount
+
+  def report(self):
+    """
+    Returns list of statements and their statistics, by descending total time.
+    """
+    with self._lock:
+      stats = [(sql, dict(stat)) for (sql, stat) in self._stats.items()]
+    return sorted(stats, key=lambda el: el[1]['total'], reverse=True)
+
+  def reset(self):
+    """
+    Clear statistics gathered so far.
+    """
+    with self._lock:
+      self._stats.clear()
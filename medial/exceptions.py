@@ -98,6 +98,20 @@ class Unconfigured(MedialException):
     super().__init__(desc)
 
 
+class PoolExhausted(MedialException):
+  """
+  Raised when no database connection becomes available in the pool within the
+  configured timeout.
+  """
+
+  def __init__(self, size, msg=None):
+    self._msg = msg
+    desc = f"All {size} connections in the pool are in use"
+    if self._msg:
+      desc += ": " + self._msg
+    super().__init__(desc)
+
+
 class UnsupportedDatabase(MedialException):
   """
   Raised when attempting to use an unsupported database system.
@@ -109,3 +123,36 @@ class UnsupportedDatabase(MedialException):
     if self._msg:
       desc += ": " + self._msg
     super().__init__(desc)
+
+
+class MissingShardKey(MedialException):
+  """
+  Raised when an object of a sharded class is written without its key set,
+  so that the shard it belongs to cannot be determined.
+  """
+
+  def __init__(self, table, key, msg=None):
+    self._table = table
+    self._key = key
+    self._msg = msg
+    desc = f"Cannot determine shard of record in table '{self._table}'" \
+      f" without key '{self._key}'"
+    if self._msg:
+      desc += ": " + self._msg
+    super().__init__(desc)
+
+
+class DuplicateColumn(MedialException):
+  """
+  Raised when query results are to be keyed by column name but the query
+  returns more than one column of the same name, such as the keys of joined
+  tables.
+  """
+
+  def __init__(self, column, msg=None):
+    self._column = column
+    self._msg = msg
+    desc = f"Query returns more than one column named '{self._column}'"
+    if self._msg:
+      desc += ": " + self._msg
+    super().__init__(desc)
@@ -0,0 +1,112 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Identity map for persistent objects.
+
+Within the scope of an identity map, objects looked up through
+`Persistent.get()` or `Persistent.load_many()` are cached by class and key, so
+that repeated lookups return the same instance without querying the database.
+Committing and deleting objects keeps the map consistent.
+
+```
+with medial.identity_map(size=1000):
+  a = Thing.get('example')
+  b = Thing.get('example')
+  assert a is b
+```
+
+Outside of such a scope there is no identity map and every lookup queries the
+database.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+__current = ContextVar('medial_identity_map', default=None)
+
+
+class IdentityMap():
+  """
+  Bounded mapping of `(class, key)` to persistent objects, evicting the least
+  recently used object once the size limit is reached.
+
+  Args:
+    size (int): Maximum number of objects held.  `None` for no limit.
+  """
+
+  def __init__(self, size=1000):
+    self.size = size
+    self._objects = OrderedDict()
+
+  def __len__(self):
+    return len(self._objects)
+
+  def __contains__(self, ident):
+    return ident in self._objects
+
+  def get(self, cls, key):
+    """
+    Get object from the map, marking it as recently used.
+
+    Returns: The object, or `None` if it is not in the map.
+    """
+    try:
+      obj = self._objects[(cls, key)]
+    except KeyError:
+      return None
+    self._objects.move_to_end((cls, key))
+    return obj
+
+  def add(self, obj):
+    """
+    Add object to the map under its class and key, replacing any object
+    already there.
+    """
+    ident = (type(obj), getattr(obj, type(obj).key))
+    self._objects[ident] = obj
+    self._objects.move_to_end(ident)
+    if self.size is not None:
+      while len(self._objects) > self.size:
+        self._objects.popitem(last=False)
+
+  def discard(self, cls, key):
+    """
+    Remove object from the map, if present.
+    """
+    self._objects.pop((cls, key), None)
+
+  def clear(self):
+    """
+    Remove all objects from the map.
+    """
+    self._objects.clear()
+
+
+def get_identity_map():
+  """
+  Get the identity map of the current scope.
+
+  Returns: Current identity map, or `None` outside of an identity map scope.
+  """
+  return __current.get()
+
+
+@contextmanager
+def identity_map(size=1000):
+  """
+  Context manager establishing an identity map for the enclosed block.  Scopes
+  may be nested, in which case the inner scope has its own map.
+
+  Args:
+    size (int): Maximum number of objects held.  `None` for no limit.
+
+  Returns: The identity map.
+  """
+  imap = IdentityMap(size)
+  token = __current.set(imap)
+  try:
+    yield imap
+  finally:
+    __current.reset(token)
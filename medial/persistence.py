@@ -1,22 +1,514 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from enum import Enum
+import functools
+import itertools
 import logging
-from .db import get_db, get_last_id
-from . import exceptions
+import queue
+import threading
+import time
+import types
+import zlib
+from .aio import aget_db
+from .columnar import enum_decoder, fetch_columns
+from .db import _scope, after_transaction, configure, configured, connection, get_db
+from .db import in_transaction, transaction_open, written
+from .identity import get_identity_map
+from . import events, exceptions
+
+# ---------------------------------------------------------------------------
+#                                                           class metadata
+# ---------------------------------------------------------------------------
+
+def _storable_value(val):
+  """
+  Returns database-friendly representation of value.
+  """
+  if isinstance(val, Enum):
+    return val.value
+  return val
+
+def _dictable_value(val):
+  """
+  Returns dict-friendly representation of value.
+  """
+  if isinstance(val, Enum):
+    return val.name
+  return val
+
+def _enum_converter(terp):
+  """
+  Returns function converting stored values to the given enumeration.
+  """
+  def convert(value):
+    if value is None:
+      return None
+    return terp(value)
+  return convert
+
+
+def _key_of(value):
+  """
+  Returns key of a referenced object, or the value itself if it is already a
+  key.
+  """
+  if isinstance(value, Persistent):
+    return getattr(value, type(value)._meta.key)
+  return value
+
+
+def _prefetch(batches):
+  """
+  Generator yielding from the given iterable of batches while a background
+  thread fetches the next batch.
+  """
+
+  done = object()
+  slots = queue.Queue(maxsize=1)
+  stop = threading.Event()
+
+  def fetch():
+    try:
+      for batch in batches:
+        while not stop.is_set():
+          try:
+            slots.put((batch, None), timeout=0.1)
+            break
+          except queue.Full:
+            continue
+        if stop.is_set():
+          return
+      slots.put((done, None))
+    except Exception as e: # pylint: disable=broad-except
+      slots.put((done, e))
+    finally:
+      # release the underlying cursor if iteration was abandoned
+      if hasattr(batches, 'close'):
+        batches.close()
+
+  # the thread runs in a copy of the current context, so that its statements
+  # are attributed to the same Persistent class
+  fetcher = threading.Thread(target=contextvars.copy_context().run, args=(fetch,),
+                             name='medial-prefetch', daemon=True)
+  fetcher.start()
+  try:
+    while True:
+      (batch, error) = slots.get()
+      if batch is done:
+        if error:
+          raise error
+        return
+      yield batch
+  finally:
+    stop.set()
+    fetcher.join()
+
+
+def default_shard(key):
+  """
+  Default shard function of sharded classes, returning integer keys as they
+  are and a checksum of others, which unlike `hash()` is stable across
+  processes.
+  """
+  if isinstance(key, int):
+    return key
+  return zlib.crc32(str(key).encode('utf8'))
+
+
+def _invalidate(cache, key, database):
+  """
+  Remove a record from a cache after it has been written.  Within a
+  transaction the record is removed again once the transaction ends, since
+  until then concurrent readers may cache the record as it was.
+  """
+  cache.delete(key)
+  after_transaction(lambda: cache.delete(key), database)
+
+
+def _operation(method):
+  """
+  Decorator of Persistent methods and class methods executing statements.
+  Connections checked out for the operation are released when it ends,
+  unless within a `medial.connection()` block, and the class on whose behalf
+  statements are executed is noted for query events.
+  """
+
+  @functools.wraps(method)
+  def wrapper(target, *args, **kwargs):
+    with _scope():
+      if not events.active:
+        return method(target, *args, **kwargs)
+      with events.on_behalf_of(target if isinstance(target, type) else type(target)):
+        return method(target, *args, **kwargs)
+  return wrapper
+
+
+# threads querying several shards at once; created on first use
+_scatter_executor = None
+_scatter_lock = threading.Lock()
+
+# serializes configuration of shards on first use
+_shard_lock = threading.Lock()
+
+def _shard(uri):
+  """
+  Returns the name of the database of a shard, configuring it with default
+  options the first time it is used unless already configured.
+  """
+  if not configured(uri):
+    with _shard_lock:
+      if not configured(uri):
+        configure(uri, name=uri)
+  return uri
+
+def _gather(calls):
+  """
+  Run functions each needing a connection to a database, given as tuples of
+  database name and function, and return their results in order.  A single
+  function is run as is; several are run in parallel threads, each on its own
+  connection.
+  """
+
+  global _scatter_executor # pylint: disable=global-statement
+
+  if len(calls) < 2:
+    return [fn() for (_, fn) in calls]
+
+  persistent = events.persistent()
+
+  def run(name, fn):
+    with connection(name), events.on_behalf_of(persistent):
+      return fn()
+
+  with _scatter_lock:
+    if _scatter_executor is None:
+      _scatter_executor = ThreadPoolExecutor(thread_name_prefix='medial-shard')
+  futures = [_scatter_executor.submit(run, name, fn) for (name, fn) in calls]
+  return [future.result() for future in futures]
+
+
+class _Reference():
+  """
+  Descriptor for a property referencing an object of another Persistent
+  class.  The property holds the referenced object's key until first access,
+  when the object is looked up and held in its place.  For classes using
+  compact storage, values are held in the property's slot, given as its
+  member descriptor.
+  """
+
+  __slots__ = ('name', 'target', 'slot')
+
+  def __init__(self, name, target, slot=None):
+    self.name = name
+    self.target = target
+    self.slot = slot
+
+  def raw(self, obj):
+    """
+    Returns the referenced object if already looked up, or otherwise its key.
+    """
+    if self.slot is not None:
+      return self.slot.__get__(obj)
+    try:
+      return obj.__dict__[self.name]
+    except KeyError:
+      raise AttributeError(self.name) from None
+
+  def __get__(self, obj, objtype=None):
+    if obj is None:
+      return self
+    value = self.raw(obj)
+    if value is None or isinstance(value, Persistent):
+      return value
+    value = self.target.get(value)
+    self.__set__(obj, value)
+    return value
+
+  def __set__(self, obj, value):
+    if self.slot is not None:
+      self.slot.__set__(obj, value)
+    else:
+      obj.__dict__[self.name] = value
+
+
+# dirtiness tracking and value access for classes using compact storage,
+# installed in place of the default methods of Persistent
+
+def _compact_init_storage(self, new):
+  self._dirty = 0
+
+def _compact_stored(self, name):
+  try:
+    return type(self)._meta.members[name].__get__(self)
+  except AttributeError:
+    raise KeyError(name) from None
+
+def _compact_mark_dirty(self, name):
+  self._dirty |= type(self)._meta.bits[name]
+
+def _compact_clear_dirty(self):
+  self._dirty = 0
+
+def _compact_dirty(self):
+  """
+  Returns list of updated attributes.
+  """
+  dirty = self._dirty
+  bits = type(self)._meta.bits
+  return [el for el in type(self)._meta.properties if dirty & bits[el]]
+
+
+class _Metadata():
+  """
+  Persistence metadata compiled once per class from its `persistence`
+  specification when the class is defined, so that the specification need not
+  be walked again on every instantiation, update or commit.  As a consequence,
+  changes to `persistence` after the class is defined are not picked up.
+  """
+
+  def __init__(self, cls):
+    persistence = cls.persistence
+    self.table = getattr(cls, 'table', None)
+    self.key = cls.key
+    self.properties = list(persistence)
+
+    # property-column mappings
+    self.columns = {}
+    self.property_columns = {}
+    for (property, spec) in persistence.items():
+      column = spec.get('column', property)
+      self.columns[column] = property
+      self.property_columns[property] = column
+
+    # conversion of stored values on load, and references to other classes
+    self.converters = {}
+    self.references = {}
+    for (property, spec) in persistence.items():
+      terp = spec.get('type')
+      if isinstance(terp, type) and issubclass(terp, Enum):
+        self.converters[property] = _enum_converter(terp)
+      elif isinstance(terp, type) and issubclass(terp, Persistent):
+        self.references[property] = terp
+
+    # checks and transformations on setting
+    self.readonly = {
+      property for (property, spec) in persistence.items()
+      if spec.get('readonly', False)
+    }
+    self.validators = {
+      property: (spec['validation_fn'], spec.get('validation_params', None))
+      for (property, spec) in persistence.items()
+      if spec.get('validation_fn', None)
+    }
+    self.setters = {
+      property: spec['setter_override']
+      for (property, spec) in persistence.items()
+      if spec.get('setter_override', None)
+    }
+
+    # compact storage: property values held in slots, given by their member
+    # descriptors if the class has them, dirtiness in a bitmask
+    self.compact = getattr(cls, 'compact', False)
+    self.members = {}
+    if self.compact:
+      for property in self.properties:
+        member = _member(cls, property)
+        if member is not None:
+          self.members[property] = member
+    self.bits = {property: 1 << i for (i, property) in enumerate(self.properties)}
+
+    # read-through cache of records by key
+    self.cache = getattr(cls, 'cache', None)
+
+    # name of the database holding the table, or of the databases holding
+    # its shards, which are named by their URIs
+    self.database = getattr(cls, 'database', None)
+    self.shards = list(getattr(cls, 'shards', None) or [])
+    self.shard_fn = getattr(cls, 'shard_fn', None) or default_shard
+
+    self.deferred = {
+      property for (property, spec) in persistence.items()
+      if spec.get('deferred', False) and property != self.key
+    }
+
+    self.defaults = [
+      (property, spec['default']) for (property, spec) in persistence.items()
+      if 'default' in spec
+    ]
+    id_spec = persistence.get('id', None)
+    self.auto_id = bool(id_spec and id_spec.get('auto', False))
+    self.id_column = self.property_columns.get('id', 'id')
+
+    # pre-rendered statements, selecting only declared non-deferred columns
+    self.select_columns = ", ".join([
+      column for (column, property) in self.columns.items()
+      if property not in self.deferred
+    ]) or "*"
+    select = f"SELECT {self.select_columns} FROM {self.table} WHERE {self.key}"
+    self.select_sql = f"{select}=?"
+    self.select_in_sql = f"{select} IN (?)"
+    self.select_any_sql = f"{select} = ANY(?)"
+    self.delete_sql = f"DELETE FROM {self.table} WHERE {self.key} = ?"
+    self._insert_sql = {}
+    self._update_sql = {}
+    self._upsert_sql = {}
+
+  def insert_sql(self, cols, rows=1, returning=False):
+    """
+    Returns INSERT statement for the given columns and number of rows,
+    optionally returning the ID of each inserted row.
+    """
+    cols = tuple(cols)
+    try:
+      return self._insert_sql[(cols, rows, returning)]
+    except KeyError:
+      value_placeholders = "(" + ", ".join(['?'] * len(cols)) + ")"
+      values = ", ".join([value_placeholders] * rows)
+      columns = ", ".join(cols)
+      qstr = f"INSERT INTO {self.table} ({columns}) VALUES {values}"
+      if returning:
+        qstr += f" RETURNING {self.id_column}"
+      self._insert_sql[(cols, rows, returning)] = qstr
+      return qstr
+
+  def update_sql(self, cols):
+    """
+    Returns UPDATE statement for the given columns.
+    """
+    cols = tuple(cols)
+    try:
+      return self._update_sql[cols]
+    except KeyError:
+      assignments = ", ".join([el + " = ?" for el in cols])
+      qstr = f"UPDATE {self.table} SET {assignments} WHERE {self.key}=?"
+      self._update_sql[cols] = qstr
+      return qstr
+
+  def upsert_sql(self, cols):
+    """
+    Returns INSERT statement for the given columns, including the key, which
+    updates the existing record in case of a conflict on the key.
+    """
+    cols = tuple(cols)
+    try:
+      return self._upsert_sql[cols]
+    except KeyError:
+      qstr = self.insert_sql(cols) + f" ON CONFLICT ({self.key})"
+      assignments = ", ".join([
+        f"{el} = excluded.{el}" for el in cols if el != self.key
+      ])
+      if assignments:
+        qstr += f" DO UPDATE SET {assignments}"
+      else:
+        qstr += " DO NOTHING"
+      self._upsert_sql[cols] = qstr
+      return qstr
+
+  @property
+  def databases(self):
+    """
+    Names of the databases holding the table's records.
+    """
+    if not self.shards:
+      return [self.database]
+    return [_shard(uri) for uri in self.shards]
+
+  def database_for(self, keyval):
+    """
+    Returns the name of the database holding the record with the given key.
+    """
+    if not self.shards:
+      return self.database
+    return _shard(self.shards[self.shard_fn(keyval) % len(self.shards)])
+
+  def partition(self, items, key=lambda el: el):
+    """
+    Returns dict of database names and the given items held in each, by key.
+    """
+    if not self.shards:
+      return {self.database: list(items)} if items else {}
+    parts = {}
+    for item in items:
+      parts.setdefault(self.database_for(key(item)), []).append(item)
+    return parts
+
+  def property_for(self, column):
+    """
+    Returns the property corresponding to a column.
+
+    Raises:
+      SchemaMismatch: No property corresponds to the column.
+    """
+    try:
+      return self.columns[column]
+    except KeyError:
+      # pylint: disable=W0707
+      logging.error("Could not get property for column %s (schema does not match object definition)", column)
+      raise exceptions.SchemaMismatch(self.table, column)
 
 # ---------------------------------------------------------------------------
 #                                                          persistent class
 # ---------------------------------------------------------------------------
 
-class Persistent():
+# instance attributes of classes using compact storage, besides properties
+_COMPACT_SLOTS = ('_dirty', '_new', '_persist')
+
+
+def _member(cls, name):
+  """
+  Returns member descriptor of the given slot of a class, if it has one.
+  """
+  for klass in cls.__mro__:
+    member = klass.__dict__.get(name)
+    if isinstance(member, _Reference) and member.slot is not None:
+      # installed in place of the slot's member descriptor
+      return member.slot
+    if isinstance(member, types.MemberDescriptorType):
+      return member
+  return None
+
+
+class _PersistentType(type):
+  """
+  Metaclass of Persistent classes, giving those using compact storage
+  `__slots__` for their properties and bookkeeping attributes, so that their
+  instances have no instance dictionary.  This is only possible when no base
+  class has one, that is when all base classes between the class and
+  `Persistent` also use compact storage.
+  """
+
+  def __new__(mcs, name, bases, namespace, **kwargs):
+    def inherit(attr, default):
+      if attr in namespace:
+        return namespace[attr]
+      return next((getattr(base, attr) for base in bases if hasattr(base, attr)), default)
+
+    if (inherit('compact', False) and '__slots__' not in namespace
+        and not any(base.__dictoffset__ for base in bases)):
+      inherited = {
+        slot for base in bases for klass in base.__mro__
+        for slot in getattr(klass, '__slots__', ())
+      }
+      namespace['__slots__'] = tuple(
+        el for el in list(_COMPACT_SLOTS) + list(inherit('persistence', {}))
+        if el not in inherited
+      )
+    return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Persistent(metaclass=_PersistentType):
   """
   Classes for persistent objects subclass this.
 
   Properties can be specified using the following fields:
   * `type`: the class of attribute.  Generally this is not used except to
-    reference an Enum or another Persistent class.
+    reference an Enum or another Persistent class.  A property referencing
+    another Persistent class is stored as the referenced object's key, and
+    the object is looked up on first access of the property.  It may be set
+    to either the object or its key.  See also `load_references()`.
   * `column`: the name of the table column matching this property.
   * `default`: the default value of the property.
   * `readonly`: defaults to `False` and can be used to block _most_ writes to
@@ -32,27 +524,139 @@ class Persistent():
     `fn(self, value)` and receives the value the caller is attempting to set.
     The function must return a value which will actually be set.  This could
     be used to transform the value before setting or perform a side effect.
+  * `deferred`: defaults to `False`.  Deferred properties are not loaded with
+    the rest of the object but on first access, which is useful for large
+    columns that are rarely needed.  See also `load_deferred()`.
+
+  Setting the class attribute `compact` to `True` stores property values in
+  slots rather than an instance dictionary and tracks dirtiness with a
+  bitmask, reducing memory use when many objects are held at once.  Updated
+  properties are then always listed in order of declaration.  Instances have
+  no instance dictionary, so cannot be given attributes other than their
+  properties.  Should a base class other than `Persistent` not use compact
+  storage, instances do have an instance dictionary, holding property values
+  as with regular storage, and only dirtiness tracking is compact.
+
+  Lookups select only the columns of declared properties, so columns in the
+  table without a matching property are ignored, except by factory loads.
+
+  Objects are stored in the default database unless the class attribute
+  `database` names another, configured with `medial.configure(uri, name=...)`.
+  Lookups and other reads use replicas of the database where configured.
+
+  Alternatively, records may be spread over several databases, or shards, by
+  setting the class attribute `shards` to a list of their URIs.  Each record
+  is held in the shard chosen by the class's `shard_fn`, a function taking a
+  key and returning an integer, modulo the number of shards.  Lookups,
+  commits and deletions of single objects go to their shard, while
+  operations involving several keys query the shards concerned in parallel
+  threads.  Keys must be assigned before objects are first committed, so
+  that automatically assigned IDs cannot be used.  Each shard is the database
+  configured under its URI as name, shared by all classes using it; to set
+  its pool size or other options, configure it with
+  `medial.configure(uri, name=uri, ...)` beforehand.  Shards not configured
+  by the time they are first used are configured then with default options.
+
+  Setting the class attribute `cache` to a cache from `medial.cache` makes
+  lookups by key read through it.  Committing or deleting an object
+  invalidates its cached record.  Lookups within a `medial.transaction()`
+  block bypass the cache, since they may see uncommitted updates.
 
   Attributes:
     key (str): The object's primary key.  Default: the object's ID.
     persistence (dict): Persistent properties and their specifications; see
       above for description of properties.
+    compact (bool): Whether to use compact storage.  Default: `False`.
+    cache (medial.cache.Cache): Cache of records by key.  Default: `None`.
+    database (str): Name of the database.  Default: the default database.
+    shards (list): URIs of shard databases.  Default: `None`.
+    shard_fn (callable): Function choosing the shard of a key.  Default:
+      `default_shard()`.
   """
 
+  # instances of classes using compact storage have no instance dictionary,
+  # which requires all base classes to declare slots
+  __slots__ = ()
+
   # class attributes
   key = 'id'
   persistence = {}
 
+  # whether to use compact storage for property values
+  compact = False
+
+  # read-through cache of records
+  cache = None
+
+  # name of the database, if not the default one
+  database = None
+
+  # URIs of the databases holding shards of the table, and function of keys
+  # choosing between them
+  shards = None
+  shard_fn = None
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    cls._meta = _Metadata(cls)
+    if cls._meta.compact:
+      cls._init_storage = _compact_init_storage
+      if cls._meta.members:
+        cls._stored = _compact_stored
+      cls._mark_dirty = _compact_mark_dirty
+      cls._clear_dirty = _compact_clear_dirty
+      cls.dirty = property(_compact_dirty)
+    for (name, target) in cls._meta.references.items():
+      setattr(cls, name, _Reference(name, target, cls._meta.members.get(name)))
+
+  def _database(self):
+    """
+    Returns the name of the database holding the object's record.
+
+    Raises:
+      MissingShardKey: The class is sharded and the object's key is not set.
+    """
+    meta = type(self)._meta
+    if not meta.shards:
+      return meta.database
+    keyval = getattr(self, meta.key, None)
+    if keyval is None:
+      raise exceptions.MissingShardKey(meta.table, meta.key)
+    return meta.database_for(keyval)
+
+  def _init_storage(self, new):
+    """
+    Set up storage of property values and their dirtiness.  For new objects
+    all properties are tracked from the start, in order of declaration.
+    """
+    if new:
+      self._dirty = dict.fromkeys(type(self)._meta.properties, False)
+    else:
+      self._dirty = {}
+
+  def _stored(self, name):
+    """
+    Returns stored value of property without loading it if deferred.
+
+    Raises:
+      KeyError: The property has not been set.
+    """
+    return self.__dict__[name]
+
+  def _mark_dirty(self, name):
+    self._dirty[name] = True
+
+  def _clear_dirty(self):
+    self._dirty.clear()
+
   def _safeset(self, property, value):
     """
     Safely sets property values according to their type.
     """
 
-    if value is not None:
-      terp = type(self).persistence[property].get('type')
-      if terp and issubclass(terp, Enum):
-        super().__setattr__(property, terp(value))
-        return
+    converter = type(self)._meta.converters.get(property)
+    if converter:
+      value = converter(value)
     super().__setattr__(property, value)
 
   def __init__(self, id=None, record=None, persist=True):
@@ -70,19 +674,12 @@ class Persistent():
     Note: Subclass initialization functions should call this first in order to
       set up the properties and set defaults.
     """
-    # on first init, add column lookup dict in class
-    # TODO: better way to do this?
-    if not hasattr(type(self), '__columns'):
-      type(self).__columns = {}
-      for (property, spec) in type(self).persistence.items():
-        column = spec.get('column', property)
-        type(self).__columns[column] = property
-
+    meta = type(self)._meta
     self._new = False
-    self._dirty = {}
     self._persist = persist
+    self._init_storage(not id and not record)
     if id:
-      super().__setattr__(type(self).key, id)
+      super().__setattr__(meta.key, id)
       self.load()
     elif record:
 
@@ -90,63 +687,59 @@ class Persistent():
       for k in record.keys():
 
         # k refers to column from database
-        try:
-          property = type(self).__columns[k]
-        except KeyError:
-          # pylint: disable=W0707
-          logging.error("Could not get property for column %s (schema does not match object definition)", k)
-          raise exceptions.SchemaMismatch(type(self).table, k)
-
-        self._safeset(property, record[k])
+        self._safeset(meta.property_for(k), record[k])
     else:
-      for (property, spec) in type(self).persistence.items():
-        if 'default' in spec:
+      for (property, default) in meta.defaults:
 
-          # setting the property value mindful of type is not strictly
-          # necessary here, because the default is declared using the
-          # Python-native value.  With other complex types, careful handling
-          # might be required.
-          self._safeset(property, spec['default'])
+        # setting the property value mindful of type is not strictly
+        # necessary here, because the default is declared using the
+        # Python-native value.  With other complex types, careful handling
+        # might be required.
+        self._safeset(property, default)
 
-          # ensure default is set on new records
-          self._dirty[property] = True
-        else:
-          self._dirty[property] = False
+        # ensure default is set on new records
+        self._mark_dirty(property)
 
       self._new = True
 
   def __setattr__(self, name, value):
-    if name in type(self).persistence:
-      property = type(self).persistence[name]
-      if property.get('readonly', False):
+    meta = type(self)._meta
+    if name in meta.property_columns:
+      if name in meta.readonly:
         raise exceptions.SettingReadOnly(name)
-      if property.get('validation_fn', None):
-        validation_fn = property['validation_fn']
-        if not validation_fn(value, params=property.get('validation_params', None)):
+      validator = meta.validators.get(name)
+      if validator:
+        (validation_fn, validation_params) = validator
+        if not validation_fn(value, params=validation_params):
           raise exceptions.InvalidValue(name, value)
-      if property.get('setter_override', None):
-        setter_fn = property['setter_override']
+      setter_fn = meta.setters.get(name)
+      if setter_fn:
         value = setter_fn(self, value)
 
-      # check if we're actually updating
-      # could use hasattr() but this is implemented with a try-except anyway
+      # check if we're actually updating; the instance dictionary is checked
+      # directly so that deferred properties are not loaded just for this
       try:
-        existing = getattr(self, name)
-
-        if value is not None:
-          # first fix the type if necessary: we make the type of the updated
-          # value consistent with the type of the existing value, since the
-          # database library has already made the appropriate determination.
-          if existing is not None and not isinstance(value, type(existing)):
-            value = type(existing)(value)
+        existing = self._stored(name)
+      except KeyError:
+        # creating new value so it's dirty by trivial case
+        self._mark_dirty(name)
+      else:
+        if name in meta.references:
+          # compare keys, so that the referenced object is not looked up
+          (existing, compared) = (_key_of(existing), _key_of(value))
+        else:
+          if value is not None:
+            # first fix the type if necessary: we make the type of the
+            # updated value consistent with the type of the existing value,
+            # since the database library has already made the appropriate
+            # determination.
+            if existing is not None and not isinstance(value, type(existing)):
+              value = type(existing)(value)
+          compared = value
 
         # mark as dirty
-        if existing != value:
-          self._dirty[name] = True
-
-      except AttributeError:
-        # creating new value so it's dirty by trivial case
-        self._dirty[name] = True
+        if existing != compared:
+          self._mark_dirty(name)
 
     super().__setattr__(name, value)
 
@@ -169,15 +762,21 @@ class Persistent():
     dupe = type(self)()
 
     # copy attributes
-    for property in type(self).persistence:
-      if property == type(self).key:
+    meta = type(self)._meta
+    for property in meta.properties:
+      if property == meta.key:
         # skip copying over object identifier
         continue
       if property in skip:
         continue
-      if not getattr(self, property):
+      if property in meta.references:
+        # copy the reference without looking up the referenced object
+        value = self._reference_key(property)
+      else:
+        value = getattr(self, property)
+      if not value:
         continue
-      setattr(dupe, property, getattr(self, property))
+      setattr(dupe, property, value)
 
     return dupe
 
@@ -188,74 +787,348 @@ class Persistent():
     """
     return [el for (el, d) in self._dirty.items() if d]
 
+  @_operation
   def commit(self):
     """
     Persist updates to the object: commit them to the database.  This method
-    only writes updated properties.
+    only writes updated properties.  Within a `medial.transaction()` block the
+    updates are committed at the end of the block.
 
     Returns: List of updated items
     """
 
     if not self._persist:
-      raise exceptions.PersistNonPersistent(self._id)
+      raise exceptions.PersistNonPersistent(getattr(self, type(self)._meta.key, None))
 
     # determine whether there are any updates
     dirty = self.dirty
     if not dirty:
       return []
 
-    table = type(self).table
+    # also ensures the key of an object of a sharded class is set beforehand
+    database = self._database()
+
+    meta = type(self)._meta
     params = [self._storable(el) for el in dirty]
-    cols = [type(self).persistence[el].get('column', el) for el in dirty]
+    cols = [meta.property_columns[el] for el in dirty]
 
     try:
       if self._new:
-        self._commit_new(table, params, cols)
+        self._commit_new(meta.table, params, cols)
       else:
-        self._commit_update(table, params, cols)
+        self._commit_update(meta.table, params, cols)
+      db = get_db(database)
+      if not in_transaction(db):
+        db.commit()
     except exceptions.MedialException as e:
       raise e
     except Exception as e:
       raise Exception(f"Unrecognized exception: {e}") from e
 
+    self._clean()
     return dirty
 
-  def _commit_new(self, table, params, cols):
+  @classmethod
+  def commit_many(cls, objects):
+    """
+    Persist updates to several objects in a single transaction.  Objects are
+    grouped by class and by the set of updated properties, and each group is
+    written with a single `executemany()` call.
 
-    value_placeholders = ", ".join(['?'] * len(params))
-    columns = ", ".join(cols)
-    qstr = f"INSERT INTO {table} ({columns}) VALUES ({value_placeholders})"
+    New objects with automatically assigned IDs are inserted with multi-row
+    `INSERT ... RETURNING` statements so that their IDs are retrieved in the
+    same round trip.  Where the database does not support `RETURNING`, they
+    are inserted one at a time, but still within the same transaction.
 
-    # commit insert to database
-    db = get_db()
-    db.execute(qstr, params)
-    db.commit()
+    Args:
+      objects (list): Persistent objects to commit.  These may be of
+        different classes.
 
-    # check if id attribute is defined and is set to auto
-    id_attr_spec = type(self).persistence.get('id', None)
-    if id_attr_spec and id_attr_spec.get('auto', False):
-      # retrieve from database
-      self.id = get_last_id()
+    Returns: List of updated items for each object, in the order given.
+    """
+    return cls._write_many(objects, upsert=False)
 
-    # clean up
-    self._dirty.clear()
+  def save(self):
+    """
+    Persist updates to the object by inserting it, or updating the existing
+    record having the same key, in a single statement using
+    `INSERT ... ON CONFLICT`.  Only updated properties are written, along with
+    the key.  Objects without a key set are simply inserted.  The key's column
+    must have a primary key or unique constraint, which the database needs to
+    detect the conflict.
+
+    Returns: List of updated items
+    """
+    return type(self).save_many([self])[0]
+
+  @classmethod
+  def save_many(cls, objects):
+    """
+    Save several objects in a single transaction, as with `save()`.  Objects
+    are grouped as with `commit_many()`.
+
+    Args:
+      objects (list): Persistent objects to save.  These may be of different
+        classes.
+
+    Returns: List of updated items for each object, in the order given.
+    """
+    return cls._write_many(objects, upsert=True)
+
+  @classmethod
+  @_operation
+  def _write_many(cls, objects, upsert):
+
+    updates = []
+    groups = {}
+    for obj in objects:
+      if not obj._persist:
+        raise exceptions.PersistNonPersistent(getattr(obj, type(obj)._meta.key, None))
+      dirty = obj.dirty
+      updates.append(dirty)
+      if not dirty:
+        continue
+      if upsert and getattr(obj, type(obj)._meta.key, None) is not None:
+        mode = 'upsert'
+      elif obj._new:
+        mode = 'insert'
+      else:
+        mode = 'update'
+      # group by the set of updated properties, in order of declaration
+      # rather than the order in which they were updated
+      dirty = set(dirty)
+      columns = tuple(el for el in type(obj)._meta.properties if el in dirty)
+      group = (type(obj), mode, columns, obj._database())
+      groups.setdefault(group, []).append(obj)
+
+    if not groups:
+      return updates
+
+    # groups of classes stored in different databases, or shards, are written
+    # to each in turn, in a transaction per database
+    dbs = []
+    try:
+      for ((klass, mode, dirty, database), group) in groups.items():
+        db = get_db(database)
+        if db not in dbs:
+          dbs.append(db)
+        klass._write_group(db, mode, dirty, group)
+      for db in dbs:
+        if not in_transaction(db):
+          db.commit()
+    except Exception as e:
+      for db in dbs:
+        if not in_transaction(db):
+          db.rollback()
+      if isinstance(e, exceptions.MedialException):
+        raise e
+      raise Exception(f"Unrecognized exception: {e}") from e
+
+    for group in groups.values():
+      for obj in group:
+        obj._clean()
+
+    return updates
+
+  @classmethod
+  @_operation
+  def _write_group(cls, db, mode, dirty, group):
+    """
+    Write a group of objects of this class having the same updated
+    properties, in one operation.
+    """
+    meta = cls._meta
+    cols = [meta.property_columns[el] for el in dirty]
+    if mode == 'upsert':
+      if meta.key not in dirty:
+        dirty = (meta.key,) + dirty
+      db.executemany(meta.upsert_sql([meta.property_columns[el] for el in dirty]), [
+        [obj._storable(el) for el in dirty] for obj in group
+      ], prepare=True)
+    elif mode == 'insert' and meta.auto_id and 'id' not in dirty:
+      cls._insert_returning(db, dirty, cols, group)
+    elif mode == 'insert':
+      db.executemany(meta.insert_sql(cols), [
+        [obj._storable(el) for el in dirty] for obj in group
+      ], prepare=True)
+    else:
+      db.executemany(meta.update_sql(cols), [
+        [obj._storable(el) for el in dirty] + [obj._storable(meta.key)]
+        for obj in group
+      ], prepare=True)
+
+  @classmethod
+  @_operation
+  def bulk_insert(cls, rows, chunk_size=1000):
+    """
+    Insert many records without creating an object for each.  Values are
+    converted and validated as when set on objects, a chunk of rows at a
+    time, and each chunk is inserted in one operation: on Postgres by
+    streaming it through `COPY ... FROM STDIN`, and otherwise with a single
+    `executemany()` call.  All chunks are inserted in one transaction, which
+    is committed at the end unless within a `medial.transaction()` block.
+
+    Defaults are applied to properties not given.  Setter overrides are not
+    called, and the objects are not added to any identity map or cache.
+
+    Args:
+      rows: Either an iterable of dicts of properties and their values, all
+        having the same properties, or a dict of properties and sequences of
+        their values.
+      chunk_size (int): Number of rows converted and inserted at a time.
+
+    Returns: Dict of the number of rows inserted (`rows`), the time taken in
+      seconds (`seconds`) and the throughput (`rows_per_sec`).
+
+    Raises:
+      InvalidValue: A value failed validation, in which case the insertion is
+        rolled back.
+    """
+
+    meta = cls._meta
+    if isinstance(rows, dict):
+      properties = list(rows)
+      rows = zip(*rows.values())
+    else:
+      rows = iter(rows)
+      try:
+        first = next(rows)
+      except StopIteration:
+        return {'rows': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+      properties = list(first)
+      rows = (
+        [row[el] for el in properties]
+        for row in itertools.chain([first], rows)
+      )
+
+    defaults = [
+      _storable_value(default) for (property, default) in meta.defaults
+      if property not in properties
+    ]
+    columns = [meta.property_columns[el] for el in properties] + [
+      meta.property_columns[property] for (property, _) in meta.defaults
+      if property not in properties
+    ]
+    validators = [
+      (i, property, meta.validators[property])
+      for (i, property) in enumerate(properties) if property in meta.validators
+    ]
+    references = [i for (i, el) in enumerate(properties) if el in meta.references]
+
+    # rows of sharded classes are inserted into their shards by key
+    if meta.shards and meta.key not in properties:
+      raise exceptions.MissingShardKey(meta.table, meta.key)
+    key = properties.index(meta.key) if meta.shards else None
+
+    dbs = []
+    count = 0
+    start = time.perf_counter()
+    try:
+      while True:
+        chunk = [list(row) for row in itertools.islice(rows, chunk_size)]
+        if not chunk:
+          break
+        for (i, property, (validation_fn, validation_params)) in validators:
+          for row in chunk:
+            if not validation_fn(row[i], params=validation_params):
+              raise exceptions.InvalidValue(property, row[i])
+        for row in chunk:
+          for i in references:
+            row[i] = _key_of(row[i])
+          row[:] = [_storable_value(value) for value in row] + defaults
+        for (database, part) in meta.partition(chunk, lambda row: row[key]).items():
+          db = get_db(database)
+          if db not in dbs:
+            dbs.append(db)
+          db.copy_rows(meta.table, columns, part)
+        count += len(chunk)
+      for db in dbs:
+        if not in_transaction(db):
+          db.commit()
+    except Exception as e:
+      for db in dbs:
+        if not in_transaction(db):
+          db.rollback()
+      if isinstance(e, exceptions.MedialException):
+        raise e
+      raise Exception(f"Unrecognized exception: {e}") from e
+
+    for database in meta.databases:
+      written(database)
+    seconds = time.perf_counter() - start
+    rate = count / seconds if seconds else 0.0
+    logging.info("Bulk inserted %d rows into %s in %.3fs (%.0f rows/s)",
+                 count, meta.table, seconds, rate)
+    return {'rows': count, 'seconds': seconds, 'rows_per_sec': rate}
+
+  def _clean(self):
+    """
+    Mark the object as clean and no longer new, after it has been committed.
+    """
+    self._clear_dirty()
     self._new = False
 
-  def _commit_update(self, table, params, cols):
+    # the cached record, if any, is now out of date
+    meta = type(self)._meta
+    database = self._database()
+    written(database)
+    if meta.cache is not None:
+      _invalidate(meta.cache, (meta.table, getattr(self, meta.key)), database)
+
+    # the committed object now reflects the stored record
+    imap = get_identity_map()
+    if imap is not None:
+      imap.add(self)
 
-    str1 = ", ".join([el + " = ?" for el in cols])
-    key = type(self).key
-    qstr = f"UPDATE {table} SET {str1} WHERE {key}=?"
-    params.append(self._storable(key))
+  @classmethod
+  def _insert_returning(cls, db, dirty, cols, group):
+    """
+    Insert new objects with automatically assigned IDs, setting their IDs.
+    """
 
-    # commit updates to database
-    db = get_db()
-    db.execute(qstr, params)
-    db.commit()
+    if not db.returning:
+      for obj in group:
+        obj._commit_new(cls._meta.table, [obj._storable(el) for el in dirty], cols)
+      return
 
-    # clean up
-    self._dirty.clear()
+    # keep within the bound parameter limit of older SQLite versions
+    chunk_size = max(1, 999 // len(cols))
+    for i in range(0, len(group), chunk_size):
+      chunk = group[i:i + chunk_size]
+      params = [obj._storable(el) for obj in chunk for el in dirty]
+      qstr = cls._meta.insert_sql(cols, rows=len(chunk), returning=True)
+      res = db.execute(qstr, params).fetchall()
+
+      # IDs are assigned in increasing order as the rows are inserted, while
+      # the order of rows returned is not guaranteed
+      ids = sorted(row[0] for row in res)
+      for (obj, id) in zip(chunk, ids):
+        obj.id = id
+
+  def _commit_new(self, table, params, cols):
+
+    meta = type(self)._meta
+    db = get_db(self._database())
+
+    # insert into database; the caller is responsible for committing
+    if not meta.auto_id:
+      db.execute(meta.insert_sql(cols), params, prepare=True)
+    elif db.type == 'postgres':
+      # retrieve ID in the same statement
+      qstr = meta.insert_sql(cols, returning=True)
+      self.id = db.execute(qstr, params, prepare=True).fetchone()[0]
+    else:
+      self.id = db.execute(meta.insert_sql(cols), params).lastrowid
 
+  def _commit_update(self, table, params, cols):
+
+    meta = type(self)._meta
+    params.append(self._storable(meta.key))
+
+    # update database; the caller is responsible for committing
+    get_db(self._database()).execute(meta.update_sql(cols), params, prepare=True)
+
+  @_operation
   def load(self, properties=None):
     """
     Fulfill an object by loading its data from the database.
@@ -264,65 +1137,486 @@ class Persistent():
       properties (list): List of properties to load from the table.
     """
 
-    key = type(self).key
-    table = type(self).table
+    meta = type(self)._meta
+    key = meta.key
+    table = meta.table
     keyval = getattr(self, key)
 
     if properties:
-      queryterms = ", ".join(properties)
+      queryterms = ", ".join([
+        meta.property_columns.get(property, property) for property in properties
+      ])
       qstr = f"SELECT {queryterms} FROM {table} WHERE {key}=?"
+      res = get_db(meta.database_for(keyval), read=True).execute(qstr, (keyval,)).fetchone()
     else:
-      qstr = f"SELECT * FROM {table} WHERE {key}=?"
-
-    db = get_db()
-    res = db.execute(qstr, (keyval,)).fetchone()
+      res = type(self)._fetch(keyval)
     if not res:
       raise exceptions.ObjectNotFound(table, key, keyval)
     for name in res.keys():
-      if name is not key:
-        try:
-          property = type(self).__columns[name]
-        except KeyError:
-          # pylint: disable=W0707
-          logging.error("Could not get property for column %s (schema does not match object definition)", name)
-          raise exceptions.SchemaMismatch(table, name)
-        self._safeset(property, res[name])
+      if name != key:
+        self._safeset(meta.property_for(name), res[name])
+
+  def __getattr__(self, name):
+    # only called when the attribute is not found, so this is where deferred
+    # properties of stored objects are loaded on first access
+    meta = type(self)._meta
+    if name in meta.deferred and not getattr(self, '_new', True):
+      self.load([name])
+      return getattr(self, name)
+    raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+  @classmethod
+  def load_deferred(cls, objects, properties=None, chunk_size=500):
+    """
+    Load deferred properties of several objects with one query per chunk of
+    objects, rather than one query per object and property on access.
+
+    Args:
+      objects (list): Objects of this class.
+      properties (list): Deferred properties to load.  Defaults to all of
+        them.
+      chunk_size (int): Maximum number of objects to load per query.
+    """
+
+    meta = cls._meta
+    key = meta.key
+    properties = list(properties or meta.deferred)
+    if not properties:
+      return
+    columns = ", ".join([key] + [meta.property_columns[el] for el in properties])
+
+    objects = {getattr(obj, key): obj for obj in objects}
+    for rec in cls._select_keys(list(objects), chunk_size, columns):
+      obj = objects[rec[key]]
+      for name in rec.keys():
+        if name != key:
+          obj._safeset(meta.property_for(name), rec[name])
+
+  @classmethod
+  @_operation
+  def _select_keys(cls, keys, chunk_size, columns=None):
+    """
+    Returns records having the given keys, with one query per chunk of keys
+    and database.  Sharded classes query the shards concerned in parallel.
+
+    Args:
+      keys (list): Keys of the records.
+      chunk_size (int): Maximum number of keys to look up per query.
+      columns (str): Columns to select.  Defaults to those selected by
+        lookups.
+    """
+
+    meta = cls._meta
+
+    def select(database, keys):
+      db = get_db(database, read=True)
+      if columns is None:
+        # psycopg2 adapts lists to arrays rather than expanding them
+        qstr = meta.select_any_sql if db.type == 'postgres' else meta.select_in_sql
+      elif db.type == 'postgres':
+        qstr = f"SELECT {columns} FROM {meta.table} WHERE {meta.key} = ANY(?)"
+      else:
+        qstr = f"SELECT {columns} FROM {meta.table} WHERE {meta.key} IN (?)"
+      records = []
+      for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        records.extend(db.execute(qstr, (chunk,), prepare=columns is None).fetchall() or [])
+      return records
+
+    results = _gather([
+      (database, lambda database=database, part=part: select(database, part))
+      for (database, part) in meta.partition(keys).items()
+    ])
+    return [rec for records in results for rec in records]
+
+  @classmethod
+  @_operation
+  def _fetch(cls, keyval):
+    """
+    Returns the record with the given key, read through the class's cache if
+    it has one, or `None` if there is no such record.
+    """
+
+    meta = cls._meta
+    database = meta.database_for(keyval)
+
+    # records read within a transaction may be uncommitted, so the cache is
+    # bypassed
+    cache = meta.cache
+    if cache is not None and transaction_open(database):
+      cache = None
+    if cache is not None:
+      res = cache.get((meta.table, keyval))
+      if res is not None:
+        return res
+
+    db = get_db(database, read=True)
+    res = db.execute(meta.select_sql, (keyval,), prepare=True).fetchone()
+    if res and cache is not None:
+      res = {name: res[name] for name in res.keys()}
+      cache.set((meta.table, keyval), res)
+    return res
+
+  @classmethod
+  def get(cls, id):
+    """
+    Look up an object by key.  Within an identity map scope, an object
+    already looked up is returned as is without querying the database;
+    otherwise this is equivalent to a lookup through initialization, except
+    that the object is created through the factory load, so subclasses must
+    accept a `record` argument on initialization.
+
+    Args:
+      id (any): The object's key.
+
+    Returns: The object.
+
+    Raises:
+      ObjectNotFound: No object exists with the given key.
+    """
+
+    imap = get_identity_map()
+    if imap is not None:
+      obj = imap.get(cls, id)
+      if obj is not None:
+        return obj
+
+    res = cls._fetch(id)
+    if not res:
+      raise exceptions.ObjectNotFound(cls._meta.table, cls._meta.key, id)
+    obj = cls(record=res)
+
+    if imap is not None:
+      imap.add(obj)
+    return obj
+
+  @classmethod
+  def load_references(cls, objects, properties=None, chunk_size=500):
+    """
+    Look up the objects referenced by several objects with one query per
+    chunk of keys and referenced class, rather than one query per object and
+    property on access.  Referenced objects already looked up are left as
+    they are, as are references to objects which do not exist, which raise
+    `ObjectNotFound` on access.
+
+    Args:
+      objects (list): Objects of this class.
+      properties (list): Properties referencing other classes to look up.
+        Defaults to all of them.
+      chunk_size (int): Maximum number of keys to look up per query.
+    """
+
+    meta = cls._meta
+    properties = list(properties or meta.references)
+
+    # gather keys to look up by referenced class
+    pending = {}
+    for property in properties:
+      descriptor = getattr(cls, property)
+      keys = pending.setdefault(meta.references[property], {})
+      for obj in objects:
+        value = descriptor.raw(obj)
+        if value is not None and not isinstance(value, Persistent):
+          keys[value] = None
+
+    found = {}
+    for (target, keys) in pending.items():
+      (loaded, _) = target.load_many(list(keys), chunk_size)
+      found[target] = {_key_of(obj): obj for obj in loaded}
+
+    for property in properties:
+      descriptor = getattr(cls, property)
+      targets = found[meta.references[property]]
+      for obj in objects:
+        value = descriptor.raw(obj)
+        if value in targets and not isinstance(value, Persistent):
+          descriptor.__set__(obj, targets[value])
+
+  @classmethod
+  def load_many(cls, keys, chunk_size=500, prefetch=None):
+    """
+    Load several objects by key using as few queries as possible.  Keys are
+    looked up in chunks, each with a single `IN` query, and the resulting
+    records are used to create objects through the factory load.  Subclasses
+    must therefore accept a `record` argument on initialization.
+
+    Within an identity map scope, objects already in the map are returned
+    without querying, and loaded objects are added to the map.  Records are
+    likewise read through the class's cache, if it has one.
+
+    Args:
+      keys (list): Keys of the objects to load.
+      chunk_size (int): Maximum number of keys to look up per query.
+      prefetch (list): Properties referencing other classes whose objects to
+        look up along with the loaded objects, as with `load_references()`,
+        or `True` for all of them.
+
+    Returns: Tuple of the list of objects found, in the order of the given
+      keys, and the list of keys for which no object was found.
+    """
+
+    meta = cls._meta
+    key = meta.key
+
+    # drop duplicate keys but preserve order
+    keys = list(dict.fromkeys(keys))
+
+    found = {}
+    imap = get_identity_map()
+    if imap is not None:
+      for keyval in keys:
+        obj = imap.get(cls, keyval)
+        if obj is not None:
+          found[keyval] = obj
+    pending = [keyval for keyval in keys if keyval not in found]
+
+    # records read within a transaction may be uncommitted, so the cache is
+    # bypassed
+    cache = meta.cache
+    if cache is not None and any(transaction_open(el) for el in meta.databases):
+      cache = None
+    if cache is not None:
+      for keyval in pending:
+        rec = cache.get((meta.table, keyval))
+        if rec is not None:
+          obj = cls(record=rec)
+          found[keyval] = obj
+          if imap is not None:
+            imap.add(obj)
+      pending = [keyval for keyval in pending if keyval not in found]
+
+    for rec in cls._select_keys(pending, chunk_size):
+      if cache is not None:
+        rec = {name: rec[name] for name in rec.keys()}
+        cache.set((meta.table, rec[key]), rec)
+      obj = cls(record=rec)
+      found[getattr(obj, key)] = obj
+      if imap is not None:
+        imap.add(obj)
+
+    objects = [found[keyval] for keyval in keys if keyval in found]
+    missing = [keyval for keyval in keys if keyval not in found]
+    if prefetch:
+      cls.load_references(objects, None if prefetch is True else prefetch, chunk_size)
+    return (objects, missing)
+
+  @classmethod
+  def iter_query(cls, sql, parameters=None, batch_size=1000, prefetch=False,
+                 references=None):
+    """
+    Generator yielding objects created through the factory load from the
+    results of a query, fetching rows in batches so that large result sets
+    are processed in constant memory.  On Postgres a server-side cursor is
+    used.  Objects may be updated and committed while iterating, since the
+    cursor outlives commits.  For sharded classes the query is run on each
+    shard in turn.
+
+    Args:
+      sql (str): Query selecting the rows of the class's table.
+      parameters (list): Query parameters.
+      batch_size (int): Number of rows fetched at a time.
+      prefetch (bool): Whether to fetch the next batch in a background thread
+        while the current one is processed.  The connection must not be used
+        for anything else until iteration is complete, so this cannot be
+        combined with `references`.
+      references (list): Properties referencing other classes whose objects to
+        look up batch by batch, as with `load_references()`, or `True` for all
+        of them.
+
+    Returns: Generator of objects.
+
+    Raises:
+      ValueError: Both `prefetch` and `references` are given.
+    """
+
+    # looking up references would use the connection being fetched from
+    if prefetch and references:
+      raise ValueError("Cannot look up references while prefetching")
+    return cls._iter_query(sql, parameters, batch_size, prefetch, references)
+
+  @classmethod
+  def _iter_query(cls, sql, parameters, batch_size, prefetch, references):
+    for database in cls._meta.databases:
+      # the connection is held until iteration of its results is complete
+      with _scope():
+        batches = get_db(database, read=True).stream(sql, parameters, batch_size)
+        if prefetch:
+          batches = _prefetch(batches)
+        while True:
+          # the query is executed as batches are fetched, so note the class
+          # around each fetch rather than across yields to the caller
+          with events.on_behalf_of(cls):
+            batch = next(batches, None)
+          if batch is None:
+            break
+          objects = [cls(record=rec) for rec in batch]
+          if references:
+            cls.load_references(objects, None if references is True else references)
+          yield from objects
+
+  @classmethod
+  @_operation
+  def select_columns(cls, properties=None, where=None, parameters=None,
+                     numpy=False, batch_size=1000):
+    """
+    Select properties of the class's records by column rather than as
+    objects, as with `medial.fetch_columns()`.  Enumerations are decoded to
+    their members, while references are left as keys.
+
+    Args:
+      properties (list): Properties to select.  Defaults to all non-deferred
+        properties.
+      where (str): Condition selecting records, if any.
+      parameters (list): Parameters of the condition.
+      numpy (bool): Whether to return NumPy arrays rather than lists.
+      batch_size (int): Number of rows fetched at a time.
+
+    Returns: Dict of properties and their values, in the order given.
+    """
+
+    meta = cls._meta
+    if properties is None:
+      properties = [el for el in meta.properties if el not in meta.deferred]
+    columns = [meta.property_columns[el] for el in properties]
+    qstr = f"SELECT {', '.join(columns)} FROM {meta.table}"
+    if where:
+      qstr += f" WHERE {where}"
+
+    decoders = {
+      column: enum_decoder(cls.persistence[property]['type'])
+      for (property, column) in zip(properties, columns)
+      if property in meta.converters
+    }
+
+    # sharded classes query all shards in parallel
+    results = _gather([
+      (database, lambda database=database: fetch_columns(
+        qstr, parameters, numpy, decoders, batch_size, database
+      ))
+      for database in meta.databases
+    ])
+    results = [res for res in results if res]
+
+    if len(results) == 1:
+      res = results[0]
+    elif numpy:
+      # pylint: disable=import-outside-toplevel
+      import numpy as np
+      res = {
+        column: np.concatenate([el[column] for el in results])
+        if results else np.asarray([])
+        for column in columns
+      }
+    else:
+      # no rows, but the columns are known, or results of several shards
+      res = {
+        column: list(itertools.chain.from_iterable(el[column] for el in results))
+        for column in columns
+      }
+    return {
+      property: res[column] for (property, column) in zip(properties, columns)
+    }
+
+  def _reference_key(self, property):
+    """
+    Returns key of the object referenced by a property, without looking it
+    up.
+    """
+    return _key_of(getattr(type(self), property).raw(self))
 
   def _dictable(self, property):
     """
     Returns dict-friendly representation of value.
     """
-    val = getattr(self, property)
-    if isinstance(val, Enum):
-      return val.name
-    return val
+    if property in type(self)._meta.references:
+      return self._reference_key(property)
+    return _dictable_value(getattr(self, property))
 
   def _storable(self, property):
     """
     Returns database-friendly representation of value.
     """
-    val = getattr(self, property)
-    if isinstance(val, Enum):
-      return val.value
-    return val
+    if property in type(self)._meta.references:
+      return self._reference_key(property)
+    return _storable_value(getattr(self, property))
 
   def to_dict(self):
     return {
       property: self._dictable(property)
-      for property in type(self).persistence
+      for property in type(self)._meta.properties
     }
 
   @classmethod
+  @_operation
   def delete(cls, id):
     """
-    Delete an object's record from the database.
+    Delete an object's record from the database.  Within a
+    `medial.transaction()` block the deletion is committed at the end of the
+    block.
 
     Args:
       id (any): The object's key.
     """
-    # create query based on what the key is
-    qstr = f"DELETE FROM {cls.table} WHERE {cls.key} = ?"
+    database = cls._meta.database_for(id)
+    db = get_db(database)
+    db.execute(cls._meta.delete_sql, (id,), prepare=True)
+    if not in_transaction(db):
+      db.commit()
+    written(database)
+
+    imap = get_identity_map()
+    if imap is not None:
+      imap.discard(cls, id)
+    if cls._meta.cache is not None:
+      _invalidate(cls._meta.cache, (cls._meta.table, id), database)
+
+
+  # -------------------------------------------------------------------------
+  #                                                       asynchronous API
+  #
+  # These run their synchronous counterparts on the current context's
+  # asynchronous connection, in its executor thread.
+  # -------------------------------------------------------------------------
+
+  async def aload(self, properties=None):
+    """
+    Asynchronous version of `load()`.
+    """
+    return await (await aget_db(self._database())).run(self.load, properties)
+
+  async def acommit(self):
+    """
+    Asynchronous version of `commit()`.
+    """
+    return await (await aget_db(self._database())).run(self.commit)
+
+  @classmethod
+  async def acommit_many(cls, objects):
+    """
+    Asynchronous version of `commit_many()`.
+    """
+    return await (await aget_db(cls._meta.databases[0])).run(cls.commit_many, objects)
+
+  @classmethod
+  async def aget(cls, id):
+    """
+    Asynchronous version of `get()`.
+    """
+    return await (await aget_db(cls._meta.database_for(id))).run(cls.get, id)
+
+  @classmethod
+  async def aload_many(cls, keys, chunk_size=500, prefetch=None):
+    """
+    Asynchronous version of `load_many()`.
+    """
+    return await (await aget_db(cls._meta.databases[0])).run(cls.load_many, keys, chunk_size, prefetch)
+
+  @classmethod
+  async def adelete(cls, id):
+    """
+    Asynchronous version of `delete()`.
+    """
+    return await (await aget_db(cls._meta.database_for(id))).run(cls.delete, id)
+
 
-    db = get_db()
-    db.execute(qstr, (id,))
-    db.commit()
+Persistent._meta = _Metadata(Persistent)
@@ -0,0 +1,312 @@
+# vi: set softtabstop=2 ts=2 sw=2 expandtab:
+# pylint:
+#
+"""
+Thread-safe pool of database connections.
+
+Connections are checked out by a thread or context, used exclusively by it,
+and released back into the pool for reuse.  The pool keeps at least a minimum
+number of connections open and opens new connections on demand up to a
+maximum, after which checkouts wait for a connection to be released.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from . import exceptions
+
+
+class Pool():
+  """
+  Pool of database connections.
+
+  Args:
+    opener (callable): Function taking no arguments and returning a new
+      database connection.
+    min_size (int): Number of connections opened up front and kept open.
+    max_size (int): Maximum number of connections open at once.
+    timeout (float): Seconds to wait for a connection to be released when the
+      pool is exhausted.  `None` to wait indefinitely.
+    check (bool): Whether to check the health of connections on checkout,
+      replacing them if they are unusable.
+  """
+
+  def __init__(self, opener, min_size=1, max_size=10, timeout=30, check=True):
+    if max_size < 1 or min_size > max_size:
+      raise ValueError(f"Invalid pool size: min {min_size}, max {max_size}")
+    self.min_size = min_size
+    self.max_size = max_size
+    self.timeout = timeout
+    self.check = check
+    self.closed = False
+    self._opener = opener
+    self._lock = threading.Condition()
+    self._idle = []
+    self._in_use = {}
+    # slots reserved for connections being opened, checked or rolled back
+    # outside of the lock
+    self._pending = 0
+    for _ in range(min_size):
+      self._idle.append(opener())
+
+  @property
+  def size(self):
+    """
+    Number of connections currently open.
+    """
+    return len(self._idle) + len(self._in_use) + self._pending
+
+  def acquire(self):
+    """
+    Check out a connection, opening a new one if none is idle and the pool is
+    not at its maximum size, or otherwise waiting for one to be released.
+
+    Returns: Database connection.
+
+    Raises:
+      PoolExhausted: No connection was released within the timeout.
+    """
+
+    deadline = None if self.timeout is None else time.monotonic() + self.timeout
+    while True:
+      (conn, dead) = self._reserve(deadline)
+      if dead:
+        self._restore(dead)
+        continue
+
+      # opening and checking connections involves round trips to the
+      # database, so is done without holding the lock
+      try:
+        if conn is None:
+          conn = self._opener()
+        elif self.check and not self._healthy(conn):
+          self._discard(conn)
+          conn = None
+      finally:
+        with self._lock:
+          self._pending -= 1
+          closed = self.closed
+          if conn is not None and not closed:
+            self._in_use[conn] = threading.current_thread()
+          else:
+            self._lock.notify()
+
+      if conn is None:
+        continue
+      if closed:
+        self._discard(conn)
+        raise exceptions.Unconfigured("connection pool has been closed")
+      return conn
+
+  def release(self, conn):
+    """
+    Return a connection to the pool.  Any uncommitted work is rolled back.
+    """
+
+    with self._lock:
+      if self._in_use.pop(conn, None) is None:
+        return
+      closed = self.closed
+      if not closed:
+        self._pending += 1
+    if closed:
+      self._discard(conn)
+    else:
+      self._restore([conn])
+
+  def close(self):
+    """
+    Close all connections, including those checked out, and the pool.
+    Connections being opened or released at the time are closed by the
+    threads doing so.
+    """
+
+    with self._lock:
+      self.closed = True
+      for conn in self._idle + list(self._in_use):
+        try:
+          conn.close()
+        except Exception as e: # pylint: disable=broad-except
+          logging.warning("Error closing connection: '%s'", e)
+      self._idle.clear()
+      self._in_use.clear()
+      self._lock.notify_all()
+
+  def _reserve(self, deadline):
+    """
+    Reserve a slot for a connection, waiting for one if necessary.
+
+    Returns: Tuple of an idle connection, or `None` if a new one is to be
+      opened, and a list of connections reclaimed from threads which have
+      exited, each also holding a reserved slot, to be restored first.
+    """
+
+    with self._lock:
+      while True:
+        if self.closed:
+          raise exceptions.Unconfigured("connection pool has been closed")
+
+        if self._idle:
+          self._pending += 1
+          return (self._idle.pop(), None)
+
+        if self.size < self.max_size:
+          self._pending += 1
+          return (None, None)
+
+        # connections checked out by threads which have since exited can no
+        # longer be released by them, so reclaim those
+        dead = [
+          conn for (conn, owner) in self._in_use.items() if not owner.is_alive()
+        ]
+        if dead:
+          for conn in dead:
+            del self._in_use[conn]
+          self._pending += len(dead)
+          return (None, dead)
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          raise exceptions.PoolExhausted(self.max_size)
+        self._lock.wait(remaining)
+
+  def _restore(self, conns):
+    """
+    Roll back connections holding reserved slots and return them to the idle
+    connections, outside of the lock.
+    """
+
+    restored = []
+    for conn in conns:
+      try:
+        conn.rollback()
+      except Exception as e: # pylint: disable=broad-except
+        logging.warning("Discarding connection which failed to roll back: '%s'", e)
+        self._discard(conn)
+      else:
+        restored.append(conn)
+
+    with self._lock:
+      self._pending -= len(conns)
+      if self.closed:
+        discard = restored
+      else:
+        discard = []
+        self._idle.extend(restored)
+      self._lock.notify(len(conns))
+    for conn in discard:
+      self._discard(conn)
+
+  @staticmethod
+  def _healthy(conn):
+    try:
+      if getattr(conn, 'closed', 0):
+        return False
+      conn.execute("SELECT 1").fetchone()
+      conn.rollback()
+    except Exception as e: # pylint: disable=broad-except
+      logging.warning("Connection failed health check: '%s'", e)
+      return False
+    return True
+
+  @staticmethod
+  def _discard(conn):
+    try:
+      conn.close()
+    except Exception: # pylint: disable=broad-except
+      pass
+
+
+class ReplicaSet():
+  """
+  Set of connection pools for replicas of a database, from which connections
+  for reading are checked out.
+
+  Args:
+    openers (list): Functions taking no arguments and returning a new
+      connection, one for each replica.
+    policy (str): How replicas are chosen: `round-robin` to take turns, or
+      `latency` for the replica whose checkouts have lately been quickest.
+      Checkouts include a health check query when pools check connections.
+    **pool_args: Arguments for each replica's pool.
+  """
+
+  POLICIES = ['round-robin', 'latency']
+
+  # weight of the latest checkout in a replica's average latency
+  SMOOTHING = 0.2
+
+  # latency charged to a replica for a failed checkout, so that others are
+  # preferred for a while
+  PENALTY = 1.0
+
+  def __init__(self, openers, policy='round-robin', **pool_args):
+    if policy not in self.POLICIES:
+      raise ValueError(f"Invalid replica policy: '{policy}'")
+    self.policy = policy
+    self._pool_args = pool_args
+    self._openers = openers
+    self._pools = [None] * len(openers)
+    self._latency = [0.0] * len(openers)
+    self._turn = itertools.count()
+    self._lock = threading.Lock()
+    self.closed = False
+
+  def _order(self):
+    count = len(self._pools)
+    with self._lock:
+      if self.policy == 'latency':
+        return sorted(range(count), key=lambda i: self._latency[i])
+      start = next(self._turn) % count
+      return [(start + i) % count for i in range(count)]
+
+  def _observe(self, i, latency):
+    with self._lock:
+      self._latency[i] += self.SMOOTHING * (latency - self._latency[i])
+
+  def _pool(self, i):
+    with self._lock:
+      if self.closed:
+        raise exceptions.Unconfigured("replica pools have been closed")
+      if self._pools[i] is None:
+        self._pools[i] = Pool(self._openers[i], **self._pool_args)
+      return self._pools[i]
+
+  def acquire(self):
+    """
+    Check out a connection from a replica, trying the others in turn if a
+    replica is unavailable.
+
+    Returns: Tuple of the pool the connection belongs to and the connection.
+
+    Raises:
+      Exception: The error of the last replica tried, if none is available.
+    """
+
+    error = None
+    for i in self._order():
+      start = time.monotonic()
+      try:
+        pool = self._pool(i)
+        conn = pool.acquire()
+      except exceptions.Unconfigured:
+        raise
+      except Exception as e: # pylint: disable=broad-except
+        logging.warning("Replica %d unavailable: '%s'", i, e)
+        self._observe(i, self.PENALTY)
+        error = e
+        continue
+      self._observe(i, time.monotonic() - start)
+      return (pool, conn)
+    raise error
+
+  def close(self):
+    """
+    Close the pools of all replicas.
+    """
+    with self._lock:
+      self.closed = True
+      pools = [pool for pool in self._pools if pool is not None]
+    for pool in pools:
+      pool.close()
@@ -5,3 +5,13 @@ CREATE TABLE products (
   model_no INTEGER,
   colour VARCHAR(32)
 );
+CREATE TABLE makers (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(32)
+);
+CREATE TABLE parts (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(32),
+  maker_id INTEGER REFERENCES makers (id),
+  supplier_id INTEGER REFERENCES makers (id)
+);
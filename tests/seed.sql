@@ -1,3 +1,8 @@
 INSERT INTO products (name, description, model_no) VALUES ('widget', 'A doohickey', 2000);
 INSERT INTO products (name, description, model_no, colour) VALUES ('squidget', 'An inky squishy doohickey', 2001, 'BLK');
 
+INSERT INTO makers (name) VALUES ('Acme');
+INSERT INTO makers (name) VALUES ('Globex');
+INSERT INTO parts (name, maker_id, supplier_id) VALUES ('sprocket', 1, 2);
+INSERT INTO parts (name, maker_id) VALUES ('cog', 2);
+INSERT INTO parts (name, maker_id, supplier_id) VALUES ('gear', 1, 1);
@@ -1,9 +1,15 @@
 # vi: set softtabstop=2 ts=2 sw=2 expandtab:
 # pylint:
 #
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+import time
 import pytest
 import medial
-from medial.db_sqlite import nextqparm
+from medial.db_sqlite import nextqparm, expand_query, open_db_sqlite, tuning
+from medial.pool import Pool
 
 # ---------------------------------------------------------------------------
 #                                        TEST PRIOR TO FIXTURE CONFIGURATION
@@ -121,11 +127,58 @@ def test_query_tokenization():
       ' AND a.resource = b.resource AND a.quota != b.quota'
     ]
 
+def test_query_expansion():
+
+  assert expand_query("SELECT * FROM products WHERE id IN (?) AND name=?", (3, None)) == \
+    "SELECT * FROM products WHERE id IN (?,?,?) AND name=?"
+  assert expand_query("SELECT * FROM products WHERE id IN (?)", (3,)) is \
+    expand_query("SELECT * FROM products WHERE id IN (?)", (3,))
+
+# ---------------------------------------------------------------------------
+#                                                         POSTGRES UTILITIES
+# ---------------------------------------------------------------------------
+
+
+def test_postgres_row():
+
+  db_postgres = pytest.importorskip('medial.db_postgres')
+  index = {'id': 0, 'name': 1}
+  row = db_postgres.Row((1, 'widget'), index)
+  assert row['name'] == 'widget'
+  assert row[0] == 1
+  assert row.keys() == ['id', 'name']
+  assert dict(row) == {'id': 1, 'name': 'widget'}
+  assert list(row) == [1, 'widget']
+  assert row == db_postgres.Row((1, 'widget'), index)
+
+def test_postgres_numbered_placeholders():
+
+  db_postgres = pytest.importorskip('medial.db_postgres')
+  assert db_postgres.numbered("SELECT * FROM products WHERE id=? AND name != '?'") == (
+    "SELECT * FROM products WHERE id=$1 AND name != '?'", 1
+  )
+  assert db_postgres.numbered("UPDATE products SET name = ?, model_no = ? WHERE id=?") == (
+    "UPDATE products SET name = $1, model_no = $2 WHERE id=$3", 3
+  )
+  assert db_postgres.numbered("SELECT 1") == ("SELECT 1", 0)
+
 # ---------------------------------------------------------------------------
 #                                                        DATABASE OPERATIONS
 # ---------------------------------------------------------------------------
 
 
+def test_postgres_copy_value():
+
+  db_postgres = pytest.importorskip('medial.db_postgres')
+  assert db_postgres.copy_value(None) == '\\N'
+  assert db_postgres.copy_value(True) == 't'
+  assert db_postgres.copy_value('a\tb\\c\n') == 'a\\tb\\\\c\\n'
+  assert db_postgres.copy_value(b'\x00\xff') == '\\\\x00ff'
+  assert db_postgres.copy_value(memoryview(b'ab')) == '\\\\x6162'
+  with pytest.raises(TypeError):
+    db_postgres.copy_value([1, 2])
+
+
 def test_basic_query(dbconn):
 
   res = dbconn.execute("SELECT * FROM products").fetchall()
@@ -133,3 +186,398 @@ def test_basic_query(dbconn):
   assert res[0]['id'] == 1
   assert res[0]['name'] == 'widget'
   assert res[0]['description'] == 'A doohickey'
+
+def test_fetch_columns(dbconn):
+
+  columns = medial.fetch_columns("SELECT name, model_no FROM products WHERE model_no >= ? ORDER BY id", (2000,), batch_size=1)
+  assert columns == {'name': ['widget', 'squidget'], 'model_no': [2000, 2001]}
+  assert medial.fetch_columns("SELECT name FROM products WHERE id < 0") == {}
+  with pytest.raises(medial.exceptions.DuplicateColumn):
+    medial.fetch_columns("SELECT p.id, m.id, m.name FROM parts p JOIN makers m ON p.maker_id = m.id")
+
+
+def test_list_query(dbconn):
+
+  if dbconn.type != 'sqlite':
+    pytest.skip("List expansion is specific to SQLite")
+  res = dbconn.execute("SELECT * FROM products WHERE id IN (?) AND name != ?", ([1, 2], 'none')).fetchall()
+  assert len(res) == 2
+  res = dbconn.execute("SELECT * FROM products WHERE id = ?", (2,)).fetchall()
+  assert len(res) == 1
+
+def test_prepared_limit(dbconn):
+
+  if dbconn.type != 'postgres':
+    pytest.skip("Prepared statements are specific to Postgres")
+  dbconn.max_prepared = 2
+  try:
+    for id in (1, 2, 3, 1):
+      res = dbconn.execute(f"SELECT {id} AS n, name FROM products WHERE id = ?", (id,), prepare=True).fetchone()
+      assert res['n'] == id
+    assert len(dbconn._statements) == 2
+    res = dbconn.execute("SELECT count(*) FROM pg_prepared_statements WHERE name LIKE 'medial_%'").fetchone()
+    assert res[0] == 2
+  finally:
+    del dbconn.max_prepared
+
+def test_sqlite_tuning(tmp_path):
+
+  uri = f"file://{tmp_path}/tuned.sqlite?preset=read-heavy&synchronous=FULL&mode=rwc"
+  db = open_db_sqlite(uri, cache_size=-2000)
+  try:
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert db.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert db.execute("PRAGMA cache_size").fetchone()[0] == -2000
+    assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+  finally:
+    db.close()
+
+  with pytest.raises(ValueError):
+    open_db_sqlite(f"file://{tmp_path}/tuned.sqlite", preset='write-only')
+  with pytest.raises(ValueError):
+    open_db_sqlite(f"file://{tmp_path}/tuned.sqlite", temp_store='MEMORY; DROP TABLE x')
+
+
+def test_sqlite_tuning_uri(tmp_path, monkeypatch):
+
+  # URIs are left as given apart from tuning options
+  assert tuning("file:data.db", {}) == ("file:data.db", {})
+  assert tuning("file::memory:?cache=shared", {}) == ("file::memory:?cache=shared", {})
+  assert tuning("file:data.db?mode=ro&synchronous=OFF&cache=shared", {}) == (
+    "file:data.db?mode=ro&cache=shared", {'synchronous': 'OFF'}
+  )
+  assert tuning("file:data.db?preset=bulk-load", {})[0] == "file:data.db"
+
+  monkeypatch.chdir(tmp_path)
+  db = open_db_sqlite("file:relative.sqlite?synchronous=OFF")
+  db.close()
+  assert (tmp_path / 'relative.sqlite').exists()
+
+  first = open_db_sqlite("file::memory:?cache=shared")
+  second = open_db_sqlite("file::memory:?cache=shared")
+  try:
+    first.execute("CREATE TABLE shared (id INTEGER)")
+    assert second.execute("SELECT COUNT(*) FROM shared").fetchone()[0] == 0
+  finally:
+    first.close()
+    second.close()
+
+# ---------------------------------------------------------------------------
+#                                                            CONNECTION POOL
+# ---------------------------------------------------------------------------
+
+
+def test_pool_exhausted():
+
+  pool = Pool(lambda: sqlite3.connect(':memory:'), min_size=0, max_size=1, timeout=0.01)
+  conn = pool.acquire()
+  with pytest.raises(medial.exceptions.PoolExhausted) as e:
+    pool.acquire()
+  assert str(e.value) == "All 1 connections in the pool are in use"
+
+  pool.release(conn)
+  assert pool.acquire() is conn
+  pool.close()
+
+
+def test_pool_opens_outside_lock():
+
+  opened = []
+  opening = threading.Event()
+  proceed = threading.Event()
+
+  def opener():
+    opened.append(True)
+    if len(opened) > 1:
+      opening.set()
+      proceed.wait(5)
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+  pool = Pool(opener, min_size=1, max_size=2, check=True)
+  first = pool.acquire()
+  thread = threading.Thread(target=pool.acquire)
+  thread.start()
+  try:
+    assert opening.wait(5)
+    # releasing and checking out the idle connection does not wait for the
+    # connection being opened
+    checkouts = []
+    other = threading.Thread(
+      target=lambda: (pool.release(first), checkouts.append(pool.acquire()))
+    )
+    other.start()
+    other.join(1)
+    assert checkouts == [first]
+    assert pool.size == 2
+  finally:
+    proceed.set()
+    thread.join()
+  assert pool.size == 2
+  pool.close()
+
+
+def test_connection_scope(dbconn):
+
+  with medial.connection() as conn:
+    # nested within the fixture's checkout, so the connection is shared
+    assert conn is dbconn
+    assert medial.get_db() is dbconn
+
+
+def test_cursor_iteration(dbconn):
+
+  cursor = dbconn.execute("SELECT id, name FROM products ORDER BY id")
+  assert [(row['id'], row['name']) for row in cursor] == [(1, 'widget'), (2, 'squidget')]
+
+
+def test_connection_per_thread(dbconn):
+
+  conns = {}
+  counts = {}
+  barrier = threading.Barrier(3)
+
+  def work(i):
+    with medial.connection() as conn:
+      conns[i] = conn
+      barrier.wait()
+      counts[i] = conn.execute("SELECT COUNT(*) AS n FROM products").fetchone()['n']
+
+  threads = [threading.Thread(target=work, args=(i,)) for i in range(3)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  # each thread had its own connection while they were all in use
+  assert len({id(conn) for conn in conns.values()}) == 3
+  assert all(conn is not dbconn for conn in conns.values())
+  assert counts == {0: 2, 1: 2, 2: 2}
+
+
+# ---------------------------------------------------------------------------
+#                                                                    CACHES
+# ---------------------------------------------------------------------------
+
+def test_memory_cache():
+
+  cache = medial.cache.MemoryCache(size=2, ttl=0.05)
+  cache.set(('things', 1), {'id': 1})
+  cache.set(('things', 2), {'id': 2})
+  assert cache.get(('things', 1)) == {'id': 1}
+  cache.set(('things', 3), {'id': 3})
+  assert cache.get(('things', 2)) is None
+  assert len(cache) == 2
+  time.sleep(0.05)
+  assert cache.get(('things', 1)) is None
+  assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_file_cache(tmp_path):
+
+  path = str(tmp_path / 'cache.sqlite')
+  writer = medial.cache.FileCache(path)
+  reader = medial.cache.FileCache(path, ttl=60)
+  try:
+    writer.set(('things', 'a'), {'name': 'a', 'size': 1})
+    assert reader.get(('things', 'a')) == {'name': 'a', 'size': 1}
+    reader.delete(('things', 'a'))
+    assert writer.get(('things', 'a')) is None
+    assert (reader.hits, writer.misses) == (1, 1)
+  finally:
+    writer.close()
+    reader.close()
+
+
+# ---------------------------------------------------------------------------
+#                                                                  REPLICAS
+# ---------------------------------------------------------------------------
+
+class Gadget(medial.Persistent):
+
+  table = 'gadgets'
+  persistence = {
+    'id': {
+      'auto': True
+    },
+    'name': {
+    },
+  }
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
+def make_gadgets(path, name):
+  conn = sqlite3.connect(path)
+  conn.execute("CREATE TABLE gadgets (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(32))")
+  conn.execute("INSERT INTO gadgets (name) VALUES (?)", (name,))
+  conn.commit()
+  conn.close()
+  return 'file://' + path
+
+
+def test_operations_release_connections(tmp_path):
+
+  medial.configure(make_gadgets(str(tmp_path / 'gadgets.sqlite'), 'gadget'),
+                   max_size=2, timeout=1)
+  try:
+    with ThreadPoolExecutor(max_workers=8) as executor:
+      names = list(executor.map(lambda _: Gadget(1).name, range(32)))
+    assert names == ['gadget'] * 32
+
+    gadget = Gadget()
+    gadget.name = 'released'
+    gadget.commit()
+    with medial.transaction():
+      Gadget.delete(gadget.id)
+
+    # no connection remains checked out
+    pool = medial.db.get_pool()
+    conns = [pool.acquire() for _ in range(2)]
+    for conn in conns:
+      pool.release(conn)
+  finally:
+    medial.close()
+
+
+def test_replicas(tmp_path):
+
+  # the "replicas" are distinct databases, so reads show where they went
+  primary = make_gadgets(str(tmp_path / 'primary.sqlite'), 'primary')
+  replicas = [
+    make_gadgets(str(tmp_path / f'replica{i}.sqlite'), f'replica{i}')
+    for i in range(2)
+  ]
+  medial.configure(primary, replicas=replicas)
+  try:
+    with medial.connection():
+      assert [Gadget(1).name for _ in range(2)] == ['replica0', 'replica0']
+    with medial.connection():
+      assert Gadget.get(1).name == 'replica1'
+      gadget = Gadget(1)
+      gadget.name = 'updated'
+      gadget.commit()
+      assert Gadget(1).name == 'replica1'
+      with medial.transaction():
+        assert Gadget(1).name == 'updated'
+  finally:
+    medial.close()
+
+
+def test_read_your_writes(tmp_path):
+
+  primary = make_gadgets(str(tmp_path / 'primary.sqlite'), 'primary')
+  replica = make_gadgets(str(tmp_path / 'replica.sqlite'), 'replica')
+  medial.configure(primary, replicas=['file:///nonexistent/replica.sqlite?mode=ro', replica],
+                   replica_policy='latency', read_your_writes=True)
+  try:
+    with medial.connection():
+      assert Gadget(1).name == 'replica'
+      Gadget.delete(1)
+      with pytest.raises(medial.exceptions.ObjectNotFound):
+        Gadget(1)
+    with medial.connection():
+      assert [Gadget(1).name for _ in range(3)] == ['replica'] * 3
+  finally:
+    medial.close()
+
+
+# ---------------------------------------------------------------------------
+#                                                           NAMED DATABASES
+# ---------------------------------------------------------------------------
+
+class HotGadget(Gadget):
+
+  database = 'hot'
+
+
+def test_named_databases(tmp_path):
+
+  medial.configure(make_gadgets(str(tmp_path / 'default.sqlite'), 'default'))
+  medial.configure(make_gadgets(str(tmp_path / 'hot.sqlite'), 'hot'), name='hot')
+  try:
+    with medial.connection(), medial.connection('hot'):
+      assert medial.get_db() is not medial.get_db('hot')
+      assert Gadget(1).name == 'default'
+      assert HotGadget(1).name == 'hot'
+
+      with medial.transaction('hot'):
+        hot = HotGadget()
+        hot.name = 'hotter'
+        hot.commit()
+        assert medial.get_db().execute("SELECT COUNT(*) FROM gadgets").fetchone()[0] == 1
+      assert medial.get_db('hot').execute("SELECT COUNT(*) FROM gadgets").fetchone()[0] == 2
+
+      gadget = Gadget()
+      gadget.name = 'mixed'
+      medial.Persistent.commit_many([gadget, HotGadget(1)])
+      (gadgets, _) = Gadget.load_many([1, gadget.id])
+      assert [el.name for el in gadgets] == ['default', 'mixed']
+
+    async def lookup():
+      async with medial.aconnection('hot'):
+        return (await HotGadget.aget(1)).name
+    assert asyncio.run(lookup()) == 'hot'
+
+    with pytest.raises(medial.exceptions.Unconfigured) as e:
+      medial.get_db('cold')
+    assert str(e.value) == "Medial has not been configured: no database named 'cold'"
+  finally:
+    medial.close()
+
+
+def test_shards(tmp_path):
+
+  uris = []
+  for i in range(2):
+    path = str(tmp_path / f'shard{i}.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE gadgets (id INTEGER PRIMARY KEY, name VARCHAR(32))")
+    conn.close()
+    uris.append('file://' + path)
+
+  class ShardedGadget(medial.Persistent):
+
+    table = 'gadgets'
+    persistence = {
+      'id': {},
+      'name': {},
+    }
+    shards = uris
+
+  # shards are configured on first use, reusing any configured beforehand
+  assert not medial.db.configured(uris[0])
+  medial.configure(uris[1], name=uris[1], max_size=2)
+
+  def count(uri):
+    return medial.get_db(uri).execute("SELECT COUNT(*) FROM gadgets").fetchone()[0]
+
+  try:
+    gadgets = []
+    for id in range(1, 6):
+      gadget = ShardedGadget()
+      gadget.id = id
+      gadget.name = f'gadget {id}'
+      gadgets.append(gadget)
+    gadgets[0].commit()
+    medial.Persistent.commit_many(gadgets[1:])
+    assert (count(uris[0]), count(uris[1])) == (2, 3)
+    assert medial.db.configured(uris[0])
+
+    assert ShardedGadget(4).name == 'gadget 4'
+    (found, missing) = ShardedGadget.load_many([5, 2, 3, 9])
+    assert [el.name for el in found] == ['gadget 5', 'gadget 2', 'gadget 3']
+    assert missing == [9]
+    query = ShardedGadget.iter_query("SELECT * FROM gadgets")
+    assert sorted(el.id for el in query) == [1, 2, 3, 4, 5]
+    assert sorted(ShardedGadget.select_columns(['id'])['id']) == [1, 2, 3, 4, 5]
+
+    ShardedGadget.delete(3)
+    assert (count(uris[0]), count(uris[1])) == (2, 2)
+
+    gadget = ShardedGadget()
+    gadget.name = 'unkeyed'
+    with pytest.raises(medial.exceptions.MissingShardKey):
+      gadget.commit()
+  finally:
+    medial.close()
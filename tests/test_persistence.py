@@ -3,7 +3,10 @@
 # Note: it is necessary to disable the "unused-argument" Pylint warning as the
 #       dbconn parameter taken by tests requires the fixture which in turn
 #       initializes the database connection.
+import asyncio
 from enum import Enum
+import threading
+import time
 import pytest
 import medial
 
@@ -79,6 +82,90 @@ class Product(medial.Persistent):
           self.colour = colour
 
 
+class CompactProduct(medial.Persistent):
+
+  table = 'products'
+  persistence = Product.persistence
+  compact = True
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
+class CachedProduct(Product):
+
+  cache = medial.cache.MemoryCache()
+
+
+class DeferredProduct(medial.Persistent):
+
+  table = 'products'
+  persistence = {
+    'id': {
+      'auto': True
+    },
+    'name': {
+    },
+    'description': {
+      'deferred': True
+    },
+    'model_no': {
+      'deferred': True
+    },
+  }
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
+class Maker(medial.Persistent):
+
+  table = 'makers'
+  persistence = {
+    'id': {
+      'auto': True
+    },
+    'name': {
+    },
+  }
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
+class Part(medial.Persistent):
+
+  table = 'parts'
+  persistence = {
+    'id': {
+      'auto': True
+    },
+    'name': {
+    },
+    'maker': {
+      'type': Maker,
+      'column': 'maker_id'
+    },
+    'supplier': {
+      'type': Maker,
+      'column': 'supplier_id'
+    },
+  }
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
+class CompactPart(medial.Persistent):
+
+  table = 'parts'
+  persistence = Part.persistence
+  compact = True
+
+  def __init__(self, id=None, record=None):
+    super().__init__(id, record=record)
+
+
 def get_all_partially_realized_products():
   db = medial.get_db()
   res = db.execute("SELECT * FROM products").fetchall()
@@ -115,12 +202,70 @@ class PartiallyRealizedProduct(medial.Persistent):
 #                                                                      TESTS
 # ---------------------------------------------------------------------------
 
+def test_compiled_metadata():
+
+  meta = Product._meta
+  assert meta is not PartiallyRealizedProduct._meta
+  assert meta.columns['model_no'] == 'model_no'
+  assert meta.auto_id
+  assert meta.select_sql == "SELECT id, name, description, model_no, colour FROM products WHERE id=?"
+  assert meta.insert_sql(['name']) is meta.insert_sql(('name',))
+  with pytest.raises(medial.exceptions.SchemaMismatch):
+    PartiallyRealizedProduct._meta.property_for('description')
+
 def test_load(dbconn):
 
   product = Product(1)
   assert product.name == 'widget'
   assert product.description == 'A doohickey'
 
+def test_load_deferred(dbconn):
+
+  product = DeferredProduct(1)
+  assert 'description' not in product.__dict__
+  assert product.description == 'A doohickey'
+  assert 'model_no' not in product.__dict__
+
+  product.model_no = 2000
+  assert product.dirty == ['model_no']
+  assert product.to_dict()['model_no'] == 2000
+
+  (products, _) = DeferredProduct.load_many([1, 2])
+  DeferredProduct.load_deferred(products)
+  assert products[1].__dict__['description'] == 'An inky squishy doohickey'
+  assert products[1].__dict__['model_no'] == 2001
+
+def test_compact(dbconn):
+
+  product = CompactProduct(2)
+  assert not hasattr(product, '__dict__')
+  assert product.name == 'squidget'
+  assert product.colour is Colour.black
+  assert product.dirty == []
+
+  product.model_no = 2001
+  assert product.dirty == []
+  product.description = 'A compact doohickey'
+  product.name = 'compact squidget'
+  assert product.dirty == ['name', 'description']
+  assert product.to_dict()['colour'] == 'black'
+
+  dupe = product.duplicate()
+  assert dupe.dirty == ['name', 'description', 'model_no', 'colour']
+  assert dupe.name == 'compact squidget'
+
+  (products, _) = CompactProduct.load_many([1, 2])
+  assert products[1].name == 'squidget'
+
+  # with a base class using regular storage, only dirtiness is compact
+  class MixedProduct(Product):
+    compact = True
+
+  product = MixedProduct(2)
+  assert product.__dict__['name'] == 'squidget'
+  product.name = 'mixed squidget'
+  assert product.dirty == ['name']
+
 def test_load_not_found(dbconn):
 
   with pytest.raises(medial.exceptions.ObjectNotFound) as e:
@@ -129,9 +274,10 @@ def test_load_not_found(dbconn):
 
 def test_unrealized_class(dbconn):
 
-  with pytest.raises(medial.exceptions.SchemaMismatch) as e:
-    assert PartiallyRealizedProduct(1)
-  assert str(e.value) == "Schema mismatch for table 'products' on column 'description'--no matching property"
+  # lookups only select the columns of declared properties
+  product = PartiallyRealizedProduct(1)
+  assert product.name == 'widget'
+  assert not hasattr(product, 'description')
 
 def test_new(dbconn):
 
@@ -342,9 +488,526 @@ def test_validation_on_update_failure(dbconn):
     product.model_no = 10000
   assert str(e.value) == "Validation failed for 'model_no' with value '10000'"
 
+def test_load_many(dbconn):
+
+  (products, missing) = Product.load_many([2, 5, 1, 2])
+  assert [product.name for product in products] == ['squidget', 'widget']
+  assert products[0].colour is Colour.black
+  assert missing == [5]
+
+def test_load_many_chunked(dbconn):
+
+  (products, missing) = Product.load_many([1, 2, 3], chunk_size=1)
+  assert [product.id for product in products] == [1, 2]
+  assert missing == [3]
+
 def test_delete(dbconn):
 
   Product.delete(1)
   products = get_all_products()
   assert len(products) == 1
   assert products[0].name == 'squidget'
+
+class TestCommitMany:
+
+  @staticmethod
+  def test_commit_many(dbconn):
+
+    products = get_all_products()
+    products[0].description = 'A batch doohickey'
+    products[1].description = 'Another batch doohickey'
+    new = [Product(name=f'batch{i}', description='Batched') for i in range(3)]
+
+    updates = medial.Persistent.commit_many(products + new)
+    assert updates[0] == ['description']
+    assert updates[1] == ['description']
+    assert updates[2] == ['name', 'description', 'model_no', 'colour']
+    assert [product.id for product in new] == [3, 4, 5]
+    assert all(not product.dirty for product in products + new)
+
+    res = dbconn.execute("SELECT * FROM products WHERE description IN ('A batch doohickey', 'Another batch doohickey')").fetchall()
+    assert len(res) == 2
+    res = dbconn.execute("SELECT * FROM products WHERE description = 'Batched'").fetchall()
+    assert len(res) == 3
+
+  @staticmethod
+  def test_commit_many_ids(dbconn):
+
+    new = [Product(name=f'bulk{i}') for i in range(300)]
+    medial.Persistent.commit_many(new)
+
+    res = dbconn.execute("SELECT id, name FROM products WHERE name LIKE 'bulk%'").fetchall()
+    assert {row['id']: row['name'] for row in res} == {
+      product.id: product.name for product in new
+    }
+
+  @staticmethod
+  def test_commit_many_grouping(dbconn):
+
+    products = get_all_products()
+    products[0].description = 'First described'
+    products[0].model_no = 2100
+    products[1].model_no = 2101
+    products[1].description = 'First numbered'
+
+    stats = medial.events.QueryStats()
+    medial.events.subscribe(after=stats)
+    try:
+      medial.Persistent.commit_many(products)
+    finally:
+      medial.events.unsubscribe(after=stats)
+    # both updates go out in one statement despite the order of updating
+    assert [stat['count'] for (_, stat) in stats.report()] == [1]
+
+    res = dbconn.execute("SELECT description, model_no FROM products ORDER BY id").fetchall()
+    assert [tuple(rec) for rec in res[:2]] == [('First described', 2100), ('First numbered', 2101)]
+
+  @staticmethod
+  def test_commit_many_nothing_dirty(dbconn):
+
+    products = get_all_products()
+    assert medial.Persistent.commit_many(products) == [[] for _ in products]
+
+  @staticmethod
+  def test_commit_many_non_persistent(dbconn):
+
+    maker = Maker.__new__(Maker)
+    medial.Persistent.__init__(maker, persist=False)
+    maker.name = 'Initech'
+    with pytest.raises(medial.exceptions.PersistNonPersistent):
+      maker.commit()
+    with pytest.raises(medial.exceptions.PersistNonPersistent):
+      medial.Persistent.commit_many([Maker(1), maker])
+
+class TestIdentityMap:
+
+  @staticmethod
+  def test_repeated_lookup(dbconn):
+
+    with medial.identity_map() as imap:
+      product = Product.get(1)
+      assert Product.get(1) is product
+      (products, missing) = Product.load_many([1, 2])
+      assert products[0] is product
+      assert missing == []
+      assert len(imap) == 2
+
+    # outside of scope lookups are independent
+    assert Product.get(1) is not product
+
+  @staticmethod
+  def test_eviction(dbconn):
+
+    with medial.identity_map(size=1) as imap:
+      product = Product.get(1)
+      Product.get(2)
+      assert len(imap) == 1
+      assert Product.get(1) is not product
+
+  @staticmethod
+  def test_commit_and_delete(dbconn):
+
+    with medial.identity_map() as imap:
+      product = Product(name='gidget', description='A gadget')
+      product.commit()
+      assert Product.get(product.id) is product
+
+      Product.delete(product.id)
+      assert (Product, product.id) not in imap
+      with pytest.raises(medial.exceptions.ObjectNotFound):
+        Product.get(product.id)
+
+class TestAsync:
+
+  @staticmethod
+  def test_load_and_commit(dbconn):
+
+    async def scenario():
+      async with medial.aconnection() as conn:
+        product = Product(name='asyncget', description='An awaitable doohickey')
+        assert await product.acommit() == ['name', 'description', 'model_no', 'colour']
+
+        loaded = await Product.aget(product.id)
+        assert loaded.name == 'asyncget'
+        loaded.description = 'An awaited doohickey'
+        assert await loaded.acommit() == ['description']
+
+        names = []
+        async for row in await conn.execute("SELECT name FROM products ORDER BY id"):
+          names.append(row['name'])
+        assert names == ['widget', 'squidget', 'asyncget']
+
+        await Product.adelete(product.id)
+        (_, missing) = await Product.aload_many([product.id])
+        assert missing == [product.id]
+
+    asyncio.run(scenario())
+
+  @staticmethod
+  def test_concurrent_tasks(dbconn):
+
+    async def lookup(id):
+      async with medial.aconnection():
+        product = Product()
+        product.id = id
+        await product.aload()
+        return product.name
+
+    async def scenario():
+      return await asyncio.gather(lookup(1), lookup(2), lookup(1))
+
+    assert asyncio.run(scenario()) == ['widget', 'squidget', 'widget']
+
+  @staticmethod
+  def test_cancelled_task(dbconn):
+
+    running = threading.Event()
+    finished = []
+
+    def query(db):
+      running.set()
+      time.sleep(0.2)
+      db.execute("SELECT COUNT(*) FROM products").fetchone()
+      finished.append(True)
+
+    async def work():
+      async with medial.aconnection() as conn:
+        await conn.run(query, conn.conn)
+
+    async def scenario():
+      task = asyncio.create_task(work())
+      while not running.is_set():
+        await asyncio.sleep(0.01)
+      task.cancel()
+      with pytest.raises(asyncio.CancelledError):
+        await task
+      # the connection is only released once the query has finished
+      return finished
+
+    assert asyncio.run(scenario()) == [True]
+
+class TestIterQuery:
+
+  @staticmethod
+  def test_iter_query(dbconn):
+
+    Product.commit_many([Product(name=f'streamed{i}') for i in range(10)])
+    products = Product.iter_query("SELECT * FROM products WHERE id > ? ORDER BY id", (2,), batch_size=3)
+    assert [product.name for product in products] == [f'streamed{i}' for i in range(10)]
+
+  @staticmethod
+  def test_iter_query_prefetch(dbconn):
+
+    products = Product.iter_query("SELECT * FROM products ORDER BY id", batch_size=4, prefetch=True)
+    assert next(products).name == 'widget'
+    assert len(list(products)) == 11
+
+  @staticmethod
+  def test_iter_query_commit(dbconn):
+
+    products = Product.iter_query("SELECT * FROM products WHERE id <= 2 ORDER BY id", batch_size=1)
+    for product in products:
+      product.description = f'Streamed and updated {product.id}'
+      product.commit()
+
+    res = dbconn.execute("SELECT description FROM products WHERE id <= 2 ORDER BY id").fetchall()
+    assert [rec['description'] for rec in res] == ['Streamed and updated 1', 'Streamed and updated 2']
+
+  @staticmethod
+  def test_iter_query_error(dbconn):
+
+    with pytest.raises(medial.exceptions.SchemaMismatch):
+      list(PartiallyRealizedProduct.iter_query("SELECT * FROM products", prefetch=True))
+
+class TestSave:
+
+  @staticmethod
+  def test_save(dbconn):
+
+    product = Product(name='widget', description='An upserted doohickey')
+    product.id = 1
+    assert product.save() == ['id', 'name', 'description', 'model_no', 'colour']
+
+    res = dbconn.execute("SELECT * FROM products WHERE id = 1").fetchone()
+    assert res['description'] == 'An upserted doohickey'
+    assert res['model_no'] is None
+    assert res['colour'] == 'GRY'
+
+    product.description = 'A re-upserted doohickey'
+    assert product.save() == ['description']
+    res = dbconn.execute("SELECT * FROM products WHERE id = 1").fetchone()
+    assert res['description'] == 'A re-upserted doohickey'
+    assert res['name'] == 'widget'
+
+  @staticmethod
+  def test_save_many(dbconn):
+
+    products = [Product(name=f'saved{i}') for i in range(3)]
+    for (i, product) in enumerate(products):
+      product.id = 20 + i
+    unkeyed = Product(name='unkeyed')
+    existing = Product(2)
+    existing.model_no = 2002
+
+    updates = medial.Persistent.save_many(products + [unkeyed, existing])
+    assert updates[-1] == ['model_no']
+    assert unkeyed.id is not None
+
+    res = dbconn.execute("SELECT COUNT(*) AS n FROM products WHERE id IN (20, 21, 22)").fetchone()
+    assert res['n'] == 3
+    res = dbconn.execute("SELECT * FROM products WHERE id = 2").fetchone()
+    assert res['model_no'] == 2002
+    assert res['name'] == 'squidget'
+
+class TestTransaction:
+
+  @staticmethod
+  def test_commit_at_end(dbconn):
+
+    with medial.transaction():
+      product = Product(1)
+      product.description = 'A transactional doohickey'
+      product.commit()
+      Product.delete(2)
+
+    (products, missing) = Product.load_many([1, 2])
+    assert products[0].description == 'A transactional doohickey'
+    assert missing == [2]
+
+  @staticmethod
+  def test_rollback(dbconn):
+
+    with pytest.raises(medial.exceptions.InvalidValue):
+      with medial.transaction():
+        product = Product(name='rolled back')
+        product.commit()
+        Product.delete(1)
+        product.model_no = 1
+
+    res = dbconn.execute("SELECT COUNT(*) AS n FROM products WHERE name = 'rolled back'").fetchone()
+    assert res['n'] == 0
+    assert Product(1).name == 'widget'
+
+  @staticmethod
+  def test_nested(dbconn):
+
+    with medial.transaction():
+      Product(name='outer').commit()
+      with pytest.raises(medial.exceptions.InvalidValue):
+        with medial.transaction():
+          Product(name='inner').commit()
+          Product(model_no=1)
+      with medial.transaction():
+        Product(name='inner kept').commit()
+
+    res = dbconn.execute("SELECT name FROM products WHERE id > 2 ORDER BY id").fetchall()
+    assert [row['name'] for row in res] == ['outer', 'inner kept']
+
+class TestEvents:
+
+  @staticmethod
+  def test_listeners(dbconn, caplog):
+
+    stats = medial.events.QueryStats()
+    seen = []
+    slow = medial.events.SlowQueryLogger(threshold=0)
+    medial.events.subscribe(before=seen.append, after=stats)
+    medial.events.subscribe(after=slow)
+    try:
+      product = Product(1)
+      product.description = 'An observed doohickey'
+      product.commit()
+      Product.load_many([1, 2])
+      dbconn.execute("SELECT 1")
+      maker = Maker(1)
+      maker.name = 'Acme Corp'
+      medial.Persistent.commit_many([maker])
+      list(Product.iter_query("SELECT * FROM products"))
+    finally:
+      medial.events.unsubscribe(before=seen.append, after=stats)
+      medial.events.unsubscribe(after=slow)
+    assert not medial.events.active
+
+    assert [event.persistent for event in seen] == [Product, Product, Product, None, Maker, Maker, Product]
+    assert seen[0].params == 1
+    assert seen[1].sql.startswith('UPDATE products SET description = ?')
+    assert seen[1].rowcount == 1
+    assert all(event.elapsed is not None for event in seen)
+
+    report = stats.report()
+    assert len(report) == 7
+    assert sum(stat['count'] for (_, stat) in report) == 7
+    assert "Slow query" in caplog.text
+
+class TestReferences:
+
+  @staticmethod
+  def test_lazy(dbconn):
+
+    stats = medial.events.QueryStats()
+    medial.events.subscribe(after=stats)
+    try:
+      part = Part(1)
+      assert part.to_dict() == {'id': 1, 'name': 'sprocket', 'maker': 1, 'supplier': 2}
+      assert sum(stat['count'] for (_, stat) in stats.report()) == 1
+      assert part.maker.name == 'Acme'
+      assert part.supplier.name == 'Globex'
+      assert part.maker is part.maker
+      assert sum(stat['count'] for (_, stat) in stats.report()) == 3
+    finally:
+      medial.events.unsubscribe(after=stats)
+
+    assert Part(2).supplier is None
+
+  @staticmethod
+  def test_update(dbconn):
+
+    part = Part(2)
+    part.maker = 2
+    assert part.dirty == []
+    part.maker = Maker(1)
+    assert part.dirty == ['maker']
+    part.supplier = 1
+    assert part.commit() == ['maker', 'supplier']
+
+    res = dbconn.execute("SELECT * FROM parts WHERE id = 2").fetchone()
+    assert (res['maker_id'], res['supplier_id']) == (1, 1)
+    assert part.supplier.name == 'Acme'
+
+    new = Part()
+    new.name = 'spring'
+    new.maker = Maker(2)
+    new.supplier = None
+    new.commit()
+    assert Part(new.id).maker.name == 'Globex'
+    assert new.duplicate().maker.name == 'Globex'
+
+  @staticmethod
+  def test_prefetch(dbconn):
+
+    stats = medial.events.QueryStats()
+    medial.events.subscribe(after=stats)
+    try:
+      (parts, _) = Part.load_many([1, 2, 3], prefetch=True)
+      assert [part.maker.name for part in parts] == ['Acme', 'Acme', 'Acme']
+      assert sum(stat['count'] for (_, stat) in stats.report()) == 2
+
+      parts = list(CompactPart.iter_query("SELECT * FROM parts ORDER BY id", references=['supplier']))
+      assert [part.supplier.name for part in parts[:3]] == ['Globex', 'Acme', 'Acme']
+      assert sum(stat['count'] for (_, stat) in stats.report()) == 4
+    finally:
+      medial.events.unsubscribe(after=stats)
+
+    with pytest.raises(ValueError):
+      Part.iter_query("SELECT * FROM parts", prefetch=True, references=True)
+
+class TestCache:
+
+  @staticmethod
+  def test_read_through(dbconn):
+
+    cache = CachedProduct.cache
+    cache.clear()
+    cache.reset_stats()
+    stats = medial.events.QueryStats()
+    medial.events.subscribe(after=stats)
+    try:
+      assert CachedProduct(1).name == 'widget'
+      assert CachedProduct.get(1).name == 'widget'
+      (products, _) = CachedProduct.load_many([1, 2])
+      assert [product.name for product in products] == ['widget', 'squidget']
+      assert CachedProduct.get(2).colour == Colour.black
+      assert sum(stat['count'] for (_, stat) in stats.report()) == 2
+    finally:
+      medial.events.unsubscribe(after=stats)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+  @staticmethod
+  def test_invalidation(dbconn):
+
+    product = CachedProduct.get(1)
+    product.description = 'A cached doohickey'
+    product.commit()
+    assert CachedProduct(1).description == 'A cached doohickey'
+
+    CachedProduct.delete(2)
+    with pytest.raises(medial.exceptions.ObjectNotFound):
+      CachedProduct.get(2)
+
+  @staticmethod
+  def test_transaction(dbconn):
+
+    cache = CachedProduct.cache
+    with pytest.raises(RuntimeError):
+      with medial.transaction():
+        product = CachedProduct(1)
+        product.description = 'An uncommitted doohickey'
+        product.commit()
+        assert CachedProduct.get(1).description == 'An uncommitted doohickey'
+        assert cache.get((CachedProduct._meta.table, 1)) is None
+        # as would a concurrent reader before the transaction ends
+        cache.set((CachedProduct._meta.table, 1), {'id': 1, 'description': 'stale'})
+        raise RuntimeError
+    assert cache.get((CachedProduct._meta.table, 1)) is None
+    assert CachedProduct.get(1).description != 'An uncommitted doohickey'
+
+class TestColumns:
+
+  @staticmethod
+  def test_select_columns(dbconn):
+
+    columns = Product.select_columns(batch_size=1)
+    assert columns == {
+      'id': [1, 2],
+      'name': ['widget', 'squidget'],
+      'description': ['A doohickey', 'An inky squishy doohickey'],
+      'model_no': [2000, 2001],
+      'colour': [None, Colour.black],
+    }
+    assert Product.select_columns(['name'], where="id > ?", parameters=(2,)) == {'name': []}
+    assert Part.select_columns(['maker'], where="name = ?", parameters=('cog',)) == {'maker': [2]}
+
+  @staticmethod
+  def test_select_columns_numpy(dbconn):
+
+    np = pytest.importorskip('numpy')
+    columns = Product.select_columns(['model_no', 'colour'], numpy=True, batch_size=1)
+    assert isinstance(columns['model_no'], np.ndarray)
+    assert columns['model_no'].sum() == 4001
+    assert list(columns['colour']) == [None, Colour.black]
+
+class TestBulkInsert:
+
+  @staticmethod
+  def test_rows(dbconn):
+
+    stats = Product.bulk_insert(({
+      'name': f'bulk{i}',
+      'model_no': 3000 + i,
+      'colour': Colour.red if i % 2 else 'BLU',
+    } for i in range(25)), chunk_size=10)
+    assert stats['rows'] == 25
+    assert stats['rows_per_sec'] > 0
+
+    res = dbconn.execute("SELECT * FROM products WHERE name LIKE 'bulk%' ORDER BY id").fetchall()
+    assert len(res) == 25
+    assert [rec['colour'] for rec in res[:2]] == ['BLU', 'RED']
+    assert res[-1]['model_no'] == 3024
+
+  @staticmethod
+  def test_columns(dbconn):
+
+    Product.bulk_insert({'name': ['plain0', 'plain1'], 'description': ['a', 'b']})
+    res = dbconn.execute("SELECT * FROM products WHERE name LIKE 'plain%' ORDER BY id").fetchall()
+    assert [(rec['description'], rec['colour']) for rec in res] == [('a', 'GRY'), ('b', 'GRY')]
+
+    Part.bulk_insert({'name': ['washer'], 'maker': [Maker(2)]})
+    assert dbconn.execute("SELECT maker_id FROM parts WHERE name = 'washer'").fetchone()[0] == 2
+
+  @staticmethod
+  def test_invalid(dbconn):
+
+    with pytest.raises(medial.exceptions.InvalidValue):
+      Product.bulk_insert([{'name': 'valid', 'model_no': 4000}] * 5 + [{'name': 'invalid', 'model_no': 1}], chunk_size=2)
+    res = dbconn.execute("SELECT COUNT(*) AS n FROM products WHERE name IN ('valid', 'invalid')").fetchone()
+    assert res['n'] == 0